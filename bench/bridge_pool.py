@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+'''
+    Benchmark for SymphonyBridge's pooled keep-alive sessions
+
+    Starts a local HTTPS stub (mutual TLS, throw-away self-signed cert
+    made with openssl) and measures the latency of send_message(), once
+    with a fresh requests.post() per call (as the bridge used to do) and
+    once through the bridge's pooled agent session.
+
+    usage:  python bench/bridge_pool.py [nr_of_calls]
+'''
+
+import BaseHTTPServer
+import json
+import os
+import shutil
+import SocketServer
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+import sidekick
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'       # allows keep-alive
+    wbufsize = -1                       # one write per response, and
+    disable_nagle_algorithm = True      # no delayed-ACK stalls
+
+    def _reply(self):
+        n = int(self.headers.get('Content-Length', 0))
+        if n:
+            self.rfile.read(n)
+        body = json.dumps({'token': 'tok', 'id': 'msg-1'})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = _reply
+    do_POST = _reply
+
+    def log_message(self, *args):
+        pass
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, *args):
+        BaseHTTPServer.HTTPServer.__init__(self, *args)
+        self.threads = []   # one per connection, joined by close()
+
+    def process_request(self, request, client_address):
+        t = threading.Thread(target=self.process_request_thread,
+                             args=(request, client_address))
+        t.daemon = True
+        self.threads.append(t)
+        t.start()
+
+    def handle_error(self, request, client_address):
+        pass    # clients closing without TLS close_notify
+
+    def close(self):
+        # (after the clients closed their connections)
+        self.shutdown()
+        self.server_close()
+        for t in self.threads:
+            t.join(5.0)
+
+def make_cert(d):
+    cert = os.path.join(d, 'cert.pem')
+    key = os.path.join(d, 'key.pem')
+    with open(os.devnull, 'w') as null:
+        subprocess.check_call(['openssl', 'req', '-x509', '-newkey',
+                               'rsa:2048', '-nodes', '-days', '1',
+                               '-subj', '/CN=localhost',
+                               '-addext', 'subjectAltName=DNS:localhost',
+                               '-keyout', key, '-out', cert],
+                              stdout=null, stderr=null)
+    return cert, key
+
+def start_stub(cert, key):
+    httpd = StubServer(('localhost', 0), StubHandler)
+    ctx = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    ctx.load_cert_chain(cert, key)
+    ctx.verify_mode = ssl.CERT_REQUIRED     # mutual TLS, like the agent
+    ctx.load_verify_locations(cert)
+    httpd.socket = ctx.wrap_socket(httpd.socket, server_side=True)
+    t = threading.Thread(target=httpd.serve_forever)
+    t.daemon = True
+    t.start()
+    return httpd
+
+def unpooled_send(url, certs, verify, sid):
+    # what SymphonyBridge.send_message did before: a new connection each time
+    data = { 'format': 'TEXT', 'message': 'hello' }
+    r = requests.post(url + 'agent/v2/stream/' + sid + '/message/create',
+                      headers={'content-type': 'application/json',
+                               'sessionToken': 'tok',
+                               'keyManagerToken': 'tok'},
+                      data=json.dumps(data), cert=certs, verify=verify)
+    if not r.status_code == 200:
+        raise Exception(" REST(%s): %s" % ('message/create', str(r)))
+
+def timed(n, fn, *args):
+    fn(*args)
+    lat = []
+    for i in range(n):
+        t0 = time.time()
+        fn(*args)
+        lat.append((time.time() - t0) * 1000.0)
+    lat.sort()
+    return sum(lat) / n, lat[n / 2], lat[int(n * 0.99)]
+
+def main():
+    n = 200
+    if len(sys.argv) > 1:
+        n = int(sys.argv[1])
+    # requests lets these override Session.verify, see requests issue #3829
+    for v in ['REQUESTS_CA_BUNDLE', 'CURL_CA_BUNDLE']:
+        os.environ.pop(v, None)
+    d = tempfile.mkdtemp()
+    httpd = None
+    sym = None
+    try:
+        cert, key = make_cert(d)
+        httpd = start_stub(cert, key)
+        url = 'https://localhost:%d/' % httpd.server_address[1]
+        certs = (cert, key)
+
+        print "%-22s %10s %10s %10s" % ('send_message', 'mean ms',
+                                        'p50 ms', 'p99 ms')
+        r = timed(n, unpooled_send, url, certs, cert, 'sid')
+        print "%-22s %10.2f %10.2f %10.2f" % (('new connection',) + r)
+        sym = sidekick.SymphonyBridge(url, certs, verify=cert)
+        r = timed(n, sym.send_message, 'sid', 'TEXT', 'hello')
+        print "%-22s %10.2f %10.2f %10.2f" % (('pooled session',) + r)
+    finally:
+        if sym:
+            sym.pod.close()
+            sym.agent.close()
+        if httpd:
+            httpd.close()
+        shutil.rmtree(d)
+
+if __name__ == '__main__':
+    main()
+
+# eof
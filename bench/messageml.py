@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+'''
+    Benchmark for Sidekick's messageML parsing
+
+    Compares the cost per message of the old path (BeautifulSoup 'xml'
+    tree, then walking it for mentions, the leading command and the
+    flattened text) with the single expat pass of MessageML, for a few
+    typical message shapes.
+
+    usage:  python bench/messageml.py
+'''
+
+import os
+import sys
+import time
+
+from bs4 import BeautifulSoup, element
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+import sidekick
+
+
+MSGS = 2000
+
+SAMPLES = [
+    ('command', '<messageML>/sk watch -all AAPL|MSFT</messageML>'),
+    ('chat', '<messageML>the quick brown fox jumps over the lazy dog, '
+             'again and again</messageML>'),
+    ('mentions', '<messageML><mention uid="7078106103900"/> and '
+                 '<mention uid="7078106103901"/>, see <b>this</b> '
+                 'and <i>that</i> by tomorrow</messageML>'),
+    ('long', '<messageML>' + ' '.join(['line %d <b>bold</b> text' % i
+                                       for i in range(50)]) +
+             '</messageML>'),
+]
+
+def soup_path(x):
+    msg = BeautifulSoup(x, 'xml')
+    mentions = [m.attrs['uid'] for m in msg.find_all("mention")]
+    command = None
+    c = msg.messageML.contents
+    if len(c) > 0 and type(c[0]) == element.NavigableString:
+        command = c[0].encode('ascii', 'backslashreplace')
+    line = []
+    for c in msg.messageML.contents:
+        if not type(c) == element.NavigableString:
+            continue
+        line.append(c.encode('ascii', 'backslashreplace'))
+    return mentions, command, ' '.join(line)
+
+def expat_path(x):
+    msg = sidekick.MessageML(x)
+    command = None
+    if msg.command is not None:
+        command = msg.command.encode('ascii', 'backslashreplace')
+    line = ' '.join([t.encode('ascii', 'backslashreplace')
+                     for t in msg.texts])
+    return msg.mentions, command, line
+
+def per_msg(fn, x):
+    # warm up, then run for at most MSGS msgs or 1s
+    fn(x)
+    n = 0
+    t0 = time.time()
+    while n < MSGS and time.time() - t0 < 1.0:
+        fn(x)
+        n += 1
+    return (time.time() - t0) / n * 1e6
+
+def main():
+    print "%-10s %14s %14s %8s" % ('message', 'soup us/msg', 'expat us/msg',
+                                   'speedup')
+    for name, x in SAMPLES:
+        assert soup_path(x) == expat_path(x)
+        soup = per_msg(soup_path, x)
+        expat = per_msg(expat_path, x)
+        print "%-10s %14.1f %14.1f %7.1fx" % (name, soup, expat,
+                                               soup / expat)
+
+if __name__ == '__main__':
+    main()
+
+# eof
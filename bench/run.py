@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+
+'''
+    Microbenchmarks for Sidekick's per-message hot paths
+
+    For each store size (10, 1k and 100k users by default) a synthetic
+    store is written to a throw-away HOME and loaded with
+    sidekick.init_state(); sidekick.connect() is given an offline
+    bridge, and outbound messages go to a sink, so nothing touches the
+    network. Each case is timed as the best of ROUNDS rounds, in
+    microseconds per call.
+
+    Every run is appended to bench/results.jsonl. With --compare the run
+    is checked against the previous one (or the run labelled --baseline)
+    and cases slower by more than --threshold are flagged; the exit
+    status is then 1 if there was a regression.
+
+    usage:  python bench/run.py [--sizes 10,1000,100000] [--only CASE]
+                                [--label NAME] [--compare]
+                                [--baseline NAME] [--threshold 0.25]
+'''
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import yaml
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+import sidekick
+
+
+ROUNDS  = 3
+BUDGET  = 0.2               # min. seconds per round
+MAXN    = 20000             # max. calls per round
+ROOMS   = 200
+UID0    = 7000000
+RESULTS = os.path.join(HERE, 'results.jsonl')
+
+# ---------------------------------------------------------------------------
+# synthetic state
+
+def uid(i):
+    return str(UID0 + i)
+
+def make_store(nusers):
+    # every 10th user has an IM and an alias, every 20th a keyword watch,
+    # every 50th is out of office, every 100th has a regex watch and a
+    # weekly announcement (user 0 has all of these)
+    tz = sidekick.pytz.timezone(sidekick.__SERVER_TIMEZONE__)
+    later = datetime.now(tz) + timedelta(days=7)
+    till = (datetime.today() + timedelta(days=30)).strftime('%x')
+    rooms = ['room%d' % i for i in range(ROOMS)]
+    users = {}
+    for i in range(nusers):
+        u = { 'alias' : {}, 'announce' : [], 'ooo' : [], 'oooNotified' : {},
+              'watch' : [], 'digest' : {} }
+        if i % 10 == 0:
+            u['im'] = 'im%d' % i
+            u['alias']['/h'] = '/sk help'
+        if i % 20 == 0:
+            u['watch'].append({ 'regex' : 'kw%d' % i, 'stream' : '*' })
+        if i % 50 == 0:
+            u['ooo'].append({ 'till' : till, 'msg' : 'vacation',
+                              'stream' : '*' })
+        if i % 100 == 0:
+            u['watch'].append({ 'regex' : 'foo.*bar%d' % i,
+                                'stream' : rooms[i % ROOMS] })
+            u['announce'].append({ 'when' : sidekick.render_time(later),
+                                   'msg' : 'weekly sync', 'repeat' : 'weekly',
+                                   'createDate' : till,
+                                   'stream' : rooms[i % ROOMS] })
+        users[uid(i)] = u
+    ims = [users[k]['im'] for k in users if 'im' in users[k]]
+    types = dict([(sid, 'ROOM') for sid in rooms])
+    now = time.time()
+    return {
+        'user' : users,
+        'config' : { 'myStreamIDs' : rooms + ims, 'streamTypes' : types },
+        'rooms' : dict([(sid, { 'name' : sid.upper(), 'members' : 10,
+                                'lastSeen' : now, 'fetched' : now })
+                        for sid in rooms]),
+        'sidekick.state.version' : '0.1',
+    }
+
+class OfflineBridge:
+    '''
+    answers the bridge calls the hot paths may make, without a network
+    '''
+
+    def get_my_id(self):
+        return '999'
+
+    def get_user_info(self, uid):
+        return { 'displayName' : 'User ' + uid,
+                 'emailAddress' : uid + '@example.com' }
+
+    def get_users(self, uids):
+        return dict([(uid, self.get_user_info(uid)) for uid in uids])
+
+    def get_user_IM(self, uid):
+        return 'im-' + uid
+
+    def get_stream_info(self, sid):
+        t = 'IM' if sid.startswith('im') else 'ROOM'
+        return { 'streamType' : { 'type' : t } }
+
+    def get_room_info(self, sid):
+        return { 'roomAttributes' : { 'name' : sid.upper() } }
+
+    def get_room_members(self, sid):
+        return []
+
+    def send_message(self, *args, **kwargs):
+        return None
+
+class Sink:
+    '''
+    stands in for the OutboundQueue: counts, but does not send
+    '''
+
+    def __init__(self):
+        self.n = 0
+
+    def put(self, sid, msgFormat, message, attachments=None, alt=None,
+            callback=None):
+        self.n += 1
+
+def setup(nusers, store=None):
+    # a fresh HOME with a synthetic store, loaded like main() does
+    home = tempfile.mkdtemp(prefix='sk-bench-')
+    os.environ['HOME'] = home
+    os.makedirs(home + '/.symphony')
+    with open(home + '/.symphony/sidekick-store.json', 'w') as f:
+        json.dump(store or make_store(nusers), f)
+    sidekick.init_state(sidekick.SidekickStore())
+    sidekick.connect(OfflineBridge())
+    sidekick.outq = Sink()
+    with open(os.path.join(HERE, '..', 'sidekick-help.yaml'), 'r') as f:
+        sidekick.help_text = yaml.load(f.read())
+    return home
+
+def event(sid, sender, text):
+    return { 'id' : 'ev', 'streamId' : sid, 'fromUserId' : int(sender),
+             'message' : '<messageML>%s</messageML>' % text }
+
+# ---------------------------------------------------------------------------
+# the cases: name -> fn(nusers), returning the function to time
+
+def case_parse_time(nusers):
+    return lambda: sidekick.parse_time('10/20/26', '09:30', 'EST')
+
+def case_is_im_room(nusers):
+    return lambda: sidekick.is_IM('room1')
+
+def case_is_im_im(nusers):
+    return lambda: sidekick.is_IM('im0')
+
+def ctx_case(handler, e):
+    # a fresh EventContext per call: parsing is part of the path
+    return lambda: handler(sidekick.EventContext(e))
+
+def case_command_chat(nusers):
+    e = event('room1', uid(1), 'the quick brown fox jumps over the lazy dog')
+    return ctx_case(sidekick.hunt_for_command, e)
+
+def case_command_alias(nusers):
+    return ctx_case(sidekick.hunt_for_command, event('room1', uid(0), '/h'))
+
+def case_regex_miss(nusers):
+    e = event('room1', uid(1), 'the quick brown fox jumps over the lazy dog')
+    return ctx_case(sidekick.hunt_for_regex, e)
+
+def case_regex_hit(nusers):
+    e = event('room0', uid(1), 'see kw0 and foo then bar0')
+    return ctx_case(sidekick.hunt_for_regex, e)
+
+def case_ooo_none(nusers):
+    return lambda: sidekick.oooEngine.notify('room1', [uid(1)])
+
+def case_ooo_notify(nusers):
+    u = sidekick.SKS.data['user'][uid(0)]
+    def run():
+        u['oooNotified'].pop('room1', None) # not yet told today
+        sidekick.oooEngine.notify('room1', [uid(0)])
+    return run
+
+def case_ooo_repeat(nusers):
+    # the room was already told today
+    sidekick.oooEngine.notify('room1', [uid(0)])
+    return lambda: sidekick.oooEngine.notify('room1', [uid(0)])
+
+def case_announce_tick(nusers):
+    # nothing due: what each keep-alive pays for the announcements
+    return lambda: sidekick.scheduler.tick()
+
+def case_store_journal(nusers):
+    def run():
+        sidekick.SKS.setVal(['config', 'bench'], time.time())
+        sidekick.SKS.sync()
+    return run
+
+def case_store_snapshot(nusers):
+    def run():
+        sidekick.SKS.dirty = True
+        sidekick.SKS.sync()
+    return run
+
+def case_store_load(nusers):
+    return lambda: sidekick.SidekickStore().load()
+
+CASES = [
+    ('parse_time',              case_parse_time),
+    ('is_IM/room',              case_is_im_room),
+    ('is_IM/im',                case_is_im_im),
+    ('hunt_for_command/chat',   case_command_chat),
+    ('hunt_for_command/alias',  case_command_alias),
+    ('hunt_for_regex/miss',     case_regex_miss),
+    ('hunt_for_regex/hit',      case_regex_hit),
+    ('ooo/none',                case_ooo_none),
+    ('ooo/notify',              case_ooo_notify),
+    ('ooo/repeat',              case_ooo_repeat),
+    ('announce/tick',           case_announce_tick),
+    ('store/sync-journal',      case_store_journal),
+    ('store/sync-snapshot',     case_store_snapshot),
+    ('store/load',              case_store_load),
+]
+
+def measure(fn):
+    # best of ROUNDS, each running BUDGET seconds (or MAXN calls)
+    fn()
+    best = None
+    for r in range(ROUNDS):
+        n = 0
+        t0 = time.time()
+        while n < MAXN and (n == 0 or time.time() - t0 < BUDGET):
+            fn()
+            n += 1
+        us = (time.time() - t0) / n * 1e6
+        if best is None or us < best:
+            best = us
+    return best
+
+# ---------------------------------------------------------------------------
+# stored runs
+
+def load_runs(fn):
+    runs = []
+    if os.path.exists(fn):
+        with open(fn, 'r') as f:
+            for line in f:
+                if line.strip():
+                    runs.append(json.loads(line))
+    return runs
+
+def git_rev():
+    try:
+        with open(os.devnull, 'w') as null:
+            return subprocess.check_output(['git', 'rev-parse', '--short',
+                                            'HEAD'], cwd=HERE,
+                                           stderr=null).strip()
+    except Exception:
+        return None
+
+def compare(results, base, threshold):
+    # prints new vs. base, returns the names of the regressed cases
+    print
+    print "vs. %s (%s, rev %s):" % (base.get('label') or 'previous run',
+                                    base['time'], base.get('rev'))
+    print "%-34s %12s %12s %8s" % ('case', 'us/call', 'baseline', 'change')
+    regressed = []
+    for name in sorted(results):
+        if not name in base['results']:
+            continue
+        old = base['results'][name]
+        change = results[name] / old - 1.0
+        flag = ''
+        if change > threshold:
+            flag = '  << SLOWER'
+            regressed.append(name)
+        print "%-34s %12.1f %12.1f %+7.0f%%%s" % (name, results[name], old,
+                                                  change * 100, flag)
+    return regressed
+
+def main():
+    parser = argparse.ArgumentParser(description='Sidekick microbenchmarks')
+    parser.add_argument('--sizes', default='10,1000,100000',
+                        help='store sizes, in users (default: %(default)s)')
+    parser.add_argument('--only', action='append', metavar='CASE',
+                        help='run the cases starting with CASE only')
+    parser.add_argument('--label', help='name for this run')
+    parser.add_argument('--results', default=RESULTS,
+                        help='file of stored runs (default: %(default)s)')
+    parser.add_argument('--compare', action='store_true',
+                        help='flag regressions against a stored run')
+    parser.add_argument('--baseline', metavar='NAME',
+                        help='compare with the run labelled NAME '
+                             '(default: the previous run)')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='slowdown flagged as regression '
+                             '(default: %(default)s)')
+    opts = parser.parse_args()
+
+    runs = load_runs(opts.results)
+    base = None
+    if opts.compare or opts.baseline:
+        if opts.baseline:
+            runs = [r for r in runs if r.get('label') == opts.baseline]
+        if len(runs) == 0:
+            print "no stored run to compare with"
+            sys.exit(2)
+        base = runs[-1]
+
+    results = {}
+    print "%-34s %12s" % ('case', 'us/call')
+    for nusers in [int(n) for n in opts.sizes.split(',')]:
+        home = setup(nusers)
+        try:
+            for name, make in CASES:
+                if opts.only and not any([name.startswith(o)
+                                          for o in opts.only]):
+                    continue
+                key = '%d/%s' % (nusers, name)
+                results[key] = measure(make(nusers))
+                print "%-34s %12.1f" % (key, results[key])
+                sys.stdout.flush()
+        finally:
+            sidekick.tracelog.close()
+            shutil.rmtree(home)
+
+    run = { 'time' : datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'label' : opts.label, 'rev' : git_rev(),
+            'python' : sys.version.split()[0], 'results' : results }
+    with open(opts.results, 'a') as f:
+        f.write(json.dumps(run, sort_keys=True) + '\n')
+
+    if base:
+        regressed = compare(results, base, opts.threshold)
+        if len(regressed) > 0:
+            print
+            print "%d case(s) slower by more than %d%%" % \
+                                      (len(regressed), opts.threshold * 100)
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
+
+# eof
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+'''
+    Benchmark for Sidekick's sharded message processing (--workers N)
+
+    Loads bench/run.py's synthetic store, plus REGEXES all-rooms regex
+    watches (which make the matching CPU-bound), and pushes synthetic
+    chat traffic (mentions, commands, watch hits) through handle_event()
+    in this process ('0' workers) and through a ShardPool of 1, 2, 4 ...
+    worker processes, reporting events/sec. Outbound messages go to a
+    sink. Scaling needs an idle core per worker, plus one for the owner.
+
+    usage:  python bench/shards.py [--users N] [--regexes N] [--events N]
+                                   [--workers 0,1,2,4]
+'''
+
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+import run
+sidekick = run.sidekick
+
+
+BATCH = 50
+WORDS = ('the quick brown fox jumps over a lazy dog market open close buy '
+         'sell report meeting today tomorrow please check numbers').split()
+
+def make_store(nusers, nregexes):
+    store = run.make_store(nusers)
+    users = store['user']
+    for i in range(nregexes):
+        users[run.uid(i % nusers)]['watch'].append(
+                              { 'regex' : 'z[aeiou]+z%d\\b' % i, 'stream' : '*' })
+    return store
+
+def make_events(n, nusers, seed=1):
+    rnd = random.Random(seed)
+    events = []
+    for k in range(n):
+        words = [rnd.choice(WORDS) for j in range(rnd.randint(5, 30))]
+        r = rnd.random()
+        if r < 0.10:    # mentions, some of them out of office
+            words.insert(rnd.randrange(len(words)),
+                         '<mention uid="%s"/>' % run.uid(rnd.randrange(nusers)))
+        elif r < 0.15:  # keyword watch hit
+            words.append('kw%d' % (20 * rnd.randrange(max(1, nusers / 20))))
+        elif r < 0.16:  # command
+            words = ['/sk', 'help']
+        events.append({ 'id' : 'ev%d' % k,
+                        'streamId' : 'room%d' % rnd.randrange(run.ROOMS),
+                        'fromUserId' : int(run.uid(rnd.randrange(nusers))),
+                        'message' : '<messageML>%s</messageML>' %
+                                    ' '.join(words) })
+    return events
+
+def inline(events):
+    for k in range(0, len(events), BATCH):
+        for e in events[k:k + BATCH]:
+            sidekick.handle_event(e)
+        with sidekick.SKS.lock:
+            sidekick.SKS.sync()
+
+def sharded(pool, events):
+    for k in range(0, len(events), BATCH):
+        pool.submit(events[k:k + BATCH])
+    pool.drain()
+
+def main():
+    parser = argparse.ArgumentParser(description='Sidekick shard scaling')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--regexes', type=int, default=500,
+                        help='all-rooms regex watches (default: %(default)s)')
+    parser.add_argument('--events', type=int, default=5000)
+    parser.add_argument('--workers', default='0,1,2,4',
+                        help='worker counts to run (default: %(default)s)')
+    opts = parser.parse_args()
+
+    store = make_store(opts.users, opts.regexes)
+    events = make_events(opts.events, opts.users)
+    print "%d users, %d regex watches, %d events, %d cpus" % \
+              (opts.users, opts.regexes, opts.events,
+               multiprocessing.cpu_count())
+    print "%8s %12s %8s" % ('workers', 'events/s', 'speedup')
+    base = None
+    for n in [int(w) for w in opts.workers.split(',')]:
+        home = run.setup(opts.users, store)
+        pool = None
+        try:
+            if n > 0:
+                pool = sidekick.ShardPool(n)
+            t0 = time.time()
+            if pool:
+                sharded(pool, events)
+            else:
+                inline(events)
+            rate = len(events) / (time.time() - t0)
+        finally:
+            if pool:
+                pool.close()
+            sidekick.tracelog.close()
+            shutil.rmtree(home)
+        if base is None:
+            base = rate
+        print "%8d %12.0f %7.2fx" % (n, rate, rate / base)
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
+
+# eof
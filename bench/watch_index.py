@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+'''
+    Benchmark for Sidekick's per-stream watch index
+
+    Compares the cost per message of the old full scan (all users, all
+    watches, re.compile for each) with WatchIndex.match(), for a growing
+    number of users and a growing number of watches in the message's room.
+
+    A second table shows keyword watches (ticker lists) for all rooms,
+    which WatchIndex matches with a single KeywordAutomaton pass.
+
+    usage:  python bench/watch_index.py
+'''
+
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+import sidekick
+
+
+ROOMS = 1000
+MSGS  = 200
+LINE  = "the quick brown fox jumps over the lazy dog, again and again"
+
+def make_users(nusers, nroom, room):
+    # every user watches some other room, nroom of them watch our room
+    users = {}
+    for i in range(nusers):
+        sid = 'room%d' % random.randrange(ROOMS)
+        users[str(i)] = {'watch': [{'regex': 'kw%d|z.*z%d' % (i, i),
+                                    'stream': sid}]}
+    for i in range(nroom):
+        users[str(i)]['watch'].append({'regex': 'kw%d' % i, 'stream': room})
+    return users
+
+def full_scan(users, sid, line):
+    found = []
+    for uid in users:
+        for w in users[uid]['watch']:
+            if not w['stream'] == '*' and not w['stream'] == sid:
+                continue
+            if re.compile(w['regex']).search(line):
+                found.append(uid)
+                break
+    return found
+
+def make_tickers(nusers):
+    users = {}
+    for i in range(nusers):
+        tickers = ['T%05d' % random.randrange(100000) for j in range(3)]
+        users[str(i)] = {'watch': [{'regex': '|'.join(tickers),
+                                    'stream': '*'}]}
+    return users
+
+def per_msg(fn, *args):
+    # warm up (lazy automaton build), then run for at most MSGS msgs or 1s
+    fn(*args)
+    n = 0
+    t0 = time.time()
+    while n < MSGS and time.time() - t0 < 1.0:
+        fn(*args)
+        n += 1
+    return (time.time() - t0) / n * 1e6
+
+def main():
+    random.seed(42)
+    room = 'room-under-test'
+    print "%8s %8s %14s %14s" % ('users', 'in-room', 'scan us/msg',
+                                 'index us/msg')
+    for nusers in [100, 1000, 10000]:
+        for nroom in [1, 10, 100]:
+            users = make_users(nusers, nroom, room)
+            wix = sidekick.WatchIndex()
+            wix.rebuild(users)
+            scan = per_msg(full_scan, users, room, LINE)
+            index = per_msg(wix.match, room, LINE)
+            print "%8d %8d %14.1f %14.1f" % (nusers, nroom, scan, index)
+
+    print
+    print "%8s %8s %14s %14s" % ('users', 'keywords', 'scan us/msg',
+                                 'index us/msg')
+    for nusers in [10, 100, 1000, 5000]:
+        users = make_tickers(nusers)
+        wix = sidekick.WatchIndex()
+        wix.rebuild(users)
+        scan = per_msg(full_scan, users, room, LINE)
+        index = per_msg(wix.match, room, LINE)
+        print "%8d %8d %14.1f %14.1f" % (nusers, 3 * nusers, scan, index)
+
+if __name__ == '__main__':
+    main()
+
+# eof
@@ -0,0 +1,468 @@
+#!/usr/bin/env python
+
+ #
+ #
+ #
+ # Copyright 2016 Symphony Communication Services, LLC
+ #
+ # Licensed to Symphony Communication Services, LLC under one
+ # or more contributor license agreements.  See the NOTICE file
+ # distributed with this work for additional information
+ # regarding copyright ownership.  The ASF licenses this file
+ # to you under the Apache License, Version 2.0 (the
+ # "License"); you may not use this file except in compliance
+ # with the License.  You may obtain a copy of the License at
+ #
+ #  http://www.apache.org/licenses/LICENSE-2.0
+ #
+ # Unless required by applicable law or agreed to in writing,
+ # software distributed under the License is distributed on an
+ # "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ # KIND, either express or implied.  See the License for the
+ # specific language governing permissions and limitations
+ # under the License.
+ #
+ #
+
+'''
+    Sidekick stand-in: a local fake of the Symphony agent and pod
+    endpoints used by SymphonyBridge, for end-to-end load tests
+
+    Serves plain HTTP. After the bot has created its datafeed, the
+    stand-in first sends set-up commands (watches, OOO entries) from
+    some users, then synthetic traffic at a given rate: chat, mentions
+    of absent users, watch hits and commands. Watch hits and commands
+    carry a token "[t:N]" which comes back in the bot's reply, giving
+    the reaction latency. Everything the bot sends can be recorded.
+
+    usage:  ./sidekick-standin.py --spawn [options]
+      or    ./sidekick-standin.py [options]
+            HOME=/tmp/sk ./sidekick.py --url http://localhost:8444/ \\
+                                       --cert CERT KEY
+'''
+
+import argparse
+import BaseHTTPServer
+from   datetime import datetime, timedelta
+import json
+import os
+import Queue
+import random
+import re
+import shutil
+import SocketServer
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urlparse
+
+
+BOT_UID = '999'
+FIRST_UID = 1000001
+
+class World:
+    '''
+    the synthetic pod: users (with their IMs), rooms, who watches which
+    keyword and who is out of office
+    '''
+
+    def __init__(self, nusers, nrooms, nwatchers, nooo):
+        self.uids = [str(FIRST_UID + i) for i in range(nusers)]
+        self.rooms = ['room%04d' % i for i in range(nrooms)]
+        self.watchers = self.uids[:nwatchers]
+        self.ooo = self.uids[nwatchers:nwatchers + nooo]
+
+    def im(self, uid):
+        return 'IM-' + uid
+
+    def keyword(self, uid):
+        return 'kw' + uid
+
+    def user(self, uid):
+        return { 'id': int(uid), 'emailAddress': 'user%s@example.com' % uid,
+                 'displayName': 'User %s' % uid }
+
+class Stats:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.generated = 0
+        self.delivered = 0
+        self.loaded = 0         # of these, load (not set-up) events
+        self.received = 0       # messages the bot sent
+        self.injected = 0       # errors we answered with on purpose
+        self.probes = {}        # token -> delivery time, until answered
+        self.nprobes = 0
+        self.latencies = []     # seconds
+        self.started = None     # first load event delivered
+        self.last = None        # last load event delivered
+
+    def delivered_events(self, events):
+        now = time.time()
+        with self.lock:
+            for e in events:
+                self.delivered += 1
+                if not 'token' in e and not e.get('load'):
+                    continue
+                self.loaded += 1
+                if self.started is None:
+                    self.started = now
+                self.last = now
+                if 'token' in e:
+                    self.probes[e['token']] = now
+                    self.nprobes += 1
+
+    def reply(self, message):
+        now = time.time()
+        with self.lock:
+            self.received += 1
+            for tok in re.findall('\\[t:([0-9]+)\\]', message):
+                t = self.probes.pop(tok, None)
+                if t is not None:
+                    self.latencies.append(now - t)
+
+    def report(self, duration):
+        with self.lock:
+            lat = sorted(self.latencies)
+            span = (self.last or 0) - (self.started or 0)
+            print
+            print "events generated   %8d   (%.1f/s offered)" % \
+                                (self.generated, self.generated / duration)
+            print "events delivered   %8d   (load: %.1f/s over %.1fs)" % \
+                                (self.delivered,
+                                 self.loaded / max(span, 1e-9), span)
+            print "bot messages       %8d" % self.received
+            print "errors injected    %8d" % self.injected
+            print "probes answered    %8d / %d" % (len(lat), self.nprobes)
+            if len(lat) > 0:
+                print "reaction latency   p50 %.1f ms   p99 %.1f ms   " \
+                      "max %.1f ms" % (lat[len(lat) / 2] * 1000.0,
+                                       lat[int(len(lat) * 0.99)] * 1000.0,
+                                       lat[-1] * 1000.0)
+
+class Traffic:
+    '''
+    generates the datafeed events: set-up commands first, then load at
+    'rate' events per second for 'duration' seconds
+    '''
+
+    def __init__(self, world, stats, opts):
+        self.world = world
+        self.stats = stats
+        self.opts = opts
+        self.q = Queue.Queue()
+        self.seq = 0
+        self.done = threading.Event()
+
+    def _event(self, sid, uid, text, **extra):
+        self.seq += 1
+        e = { 'id': 'ev%d' % self.seq, 'streamId': sid,
+              'fromUserId': int(uid), 'timestamp': int(time.time() * 1000),
+              'message': '<messageML>' + text + '</messageML>' }
+        e.update(extra)
+        with self.stats.lock:
+            self.stats.generated += 1
+        self.q.put(e)
+
+    def _token(self):
+        return str(self.seq + 1)
+
+    def setup(self):
+        w = self.world
+        till = (datetime.today() + timedelta(days=365)).strftime('%x')
+        for uid in w.watchers:
+            self._event(w.im(uid), uid, '/sk watch -all %s' % w.keyword(uid))
+        for uid in w.ooo:
+            self._event(w.im(uid), uid, '/sk ooo -all %s on leave' % till)
+
+    def one(self):
+        w = self.world
+        o = self.opts
+        uid = random.choice(w.uids)
+        room = random.choice(w.rooms)
+        x = random.random()
+        if x < o.command_rate:
+            tok = self._token()
+            self._event(w.im(uid), uid, '/sk alias [t:%s]' % tok,
+                        token=tok)
+        elif x < o.command_rate + o.watch_rate and w.watchers:
+            tok = self._token()
+            self._event(room, uid, 'news on %s today [t:%s]' %
+                        (w.keyword(random.choice(w.watchers)), tok),
+                        token=tok)
+        elif x < o.command_rate + o.watch_rate + o.mention_rate and w.ooo:
+            self._event(room, uid, 'ping <mention uid="%s"/> about it' %
+                        random.choice(w.ooo), load=True)
+        else:
+            self._event(room, uid, 'the quick brown fox jumps over the '
+                        'lazy dog', load=True)
+
+    def _run(self):
+        self.setup()
+        time.sleep(self.opts.settle)
+        t0 = time.time()
+        n = 0
+        while time.time() - t0 < self.opts.duration:
+            due = t0 + n / self.opts.rate
+            if due > time.time():
+                time.sleep(due - time.time())
+            self.one()
+            n += 1
+        self.done.set()
+
+    def start(self):
+        t = threading.Thread(target=self._run, name='traffic')
+        t.daemon = True
+        t.start()
+
+    def read(self, timeout, maxn=100):
+        # a datafeed read: wait up to timeout for events, return a batch
+        try:
+            events = [self.q.get(True, timeout)]
+        except Queue.Empty:
+            return []
+        while len(events) < maxn:
+            try:
+                events.append(self.q.get_nowait())
+            except Queue.Empty:
+                break
+        self.stats.delivered_events(events)
+        return events
+
+class StandinHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    ROUTES = [
+        ('POST', '^/sessionauth/v1/authenticate$', 'do_auth'),
+        ('POST', '^/keyauth/v1/authenticate$', 'do_auth'),
+        ('GET',  '^/pod/v1/sessioninfo$', 'do_sessioninfo'),
+        ('GET',  '^/pod/v1/admin/user/([0-9]+)$', 'do_user'),
+        ('GET',  '^/pod/v3/users$', 'do_users'),
+        ('POST', '^/pod/v1/im/create$', 'do_im_create'),
+        ('GET',  '^/pod/v1/streams/([^/]+)/info$', 'do_stream_info'),
+        ('GET',  '^/pod/v2/room/([^/]+)/info$', 'do_room_info'),
+        ('GET',  '^/pod/v2/room/([^/]+)/membership/list$', 'do_members'),
+        ('POST', '^/agent/v1/datafeed/create$', 'do_datafeed_create'),
+        ('GET',  '^/agent/v2/datafeed/([^/]+)/read$', 'do_datafeed_read'),
+        ('POST', '^/agent/v2/stream/([^/]+)/message/create$', 'do_message'),
+    ]
+
+    # endpoints which get latency and errors injected
+    FLAKY = ['do_user', 'do_users', 'do_im_create', 'do_stream_info',
+             'do_room_info', 'do_members', 'do_message']
+
+    def _reply(self, code, obj=None):
+        body = '' if obj is None else json.dumps(obj)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _route(self, method):
+        url = urlparse.urlparse(self.path)
+        self.query = urlparse.parse_qs(url.query)
+        n = int(self.headers.get('Content-Length', 0))
+        self.body = self.rfile.read(n) if n else ''
+        for m, regex, fn in self.ROUTES:
+            match = re.match(regex, url.path)
+            if m == method and match:
+                break
+        else:
+            self._reply(404, {'message': 'no such endpoint'})
+            return
+        srv = self.server
+        if fn in self.FLAKY:
+            if srv.opts.latency > 0 or srv.opts.jitter > 0:
+                time.sleep((srv.opts.latency +
+                            random.random() * srv.opts.jitter) / 1000.0)
+            if random.random() < srv.opts.error_rate:
+                with srv.stats.lock:
+                    srv.stats.injected += 1
+                self._reply(srv.opts.error_status, {'message': 'injected'})
+                return
+        getattr(self, fn)(*match.groups())
+
+    def do_GET(self):
+        self._route('GET')
+
+    def do_POST(self):
+        self._route('POST')
+
+    def do_auth(self):
+        self._reply(200, {'name': 'token', 'token': 'standin-token'})
+
+    def do_sessioninfo(self):
+        self._reply(200, {'userId': int(BOT_UID)})
+
+    def do_user(self, uid):
+        if not uid in self.server.world.uids and not uid == BOT_UID:
+            self._reply(404, {'message': 'no such user'})
+            return
+        u = self.server.world.user(uid)
+        self._reply(200, {'userAttributes': u})
+
+    def do_users(self):
+        uids = ','.join(self.query.get('uid', [])).split(',')
+        world = self.server.world
+        self._reply(200, {'users': [world.user(uid) for uid in uids
+                                               if uid in world.uids]})
+
+    def do_im_create(self):
+        uid = str(json.loads(self.body)[0])
+        self._reply(200, {'id': self.server.world.im(uid)})
+
+    def do_stream_info(self, sid):
+        if sid.startswith('IM-'):
+            self._reply(200, {'id': sid, 'streamType': {'type': 'IM'},
+                              'streamAttributes': {'members':
+                                         [int(BOT_UID), int(sid[3:])]}})
+        else:
+            self._reply(200, {'id': sid, 'streamType': {'type': 'ROOM'}})
+
+    def do_room_info(self, sid):
+        if sid.startswith('IM-'):
+            self._reply(400, {'message': 'not a room'})
+            return
+        self._reply(200, {'roomAttributes': {'name': 'Room ' + sid}})
+
+    def do_members(self, sid):
+        n = len(self.server.world.uids)
+        self._reply(200, [{'id': FIRST_UID + i} for i in range(min(n, 20))])
+
+    def do_datafeed_create(self):
+        self.server.traffic.start()
+        self._reply(200, {'id': 'standin-feed'})
+
+    def do_datafeed_read(self, feed):
+        events = self.server.traffic.read(self.server.opts.poll)
+        for e in events:
+            e.pop('token', None)
+            e.pop('load', None)
+        if len(events) == 0:
+            self._reply(204)
+        else:
+            self._reply(200, events)
+
+    def do_message(self, sid):
+        data = json.loads(self.body)
+        self.server.stats.reply(data['message'])
+        if self.server.record:
+            with self.server.stats.lock:
+                self.server.record.write(json.dumps([time.time(), sid,
+                                 data['format'], data['message']]) + '\n')
+        self._reply(200, {'id': 'msg-%d' % self.server.stats.received})
+
+    def log_message(self, *args):
+        pass
+
+class StandinServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def make_cert(d):
+    # throw-away client certificate, its CN is the bot's name
+    cert = os.path.join(d, 'cert.pem')
+    key = os.path.join(d, 'key.pem')
+    with open(os.devnull, 'w') as null:
+        subprocess.check_call(['openssl', 'req', '-x509', '-newkey',
+                               'rsa:2048', '-nodes', '-days', '1',
+                               '-subj', '/CN=sidekick-standin/',
+                               '-keyout', key, '-out', cert],
+                              stdout=null, stderr=null)
+    return cert, key
+
+def spawn_bot(url):
+    # the bot, in its own scratch HOME (so the real store is not touched)
+    home = tempfile.mkdtemp(prefix='sidekick-standin-')
+    here = os.path.dirname(os.path.abspath(__file__))
+    cert, key = make_cert(home)
+    env = dict(os.environ, HOME=home)
+    out = open(os.path.join(home, 'bot.out'), 'w')
+    p = subprocess.Popen([sys.executable, os.path.join(here, 'sidekick.py'),
+                          '--url', url, '--cert', cert, key], cwd=here,
+                         env=env, stdout=out, stderr=subprocess.STDOUT)
+    return p, home
+
+def main():
+    parser = argparse.ArgumentParser(description='Sidekick stand-in server')
+    parser.add_argument('--port', type=int, default=8444)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--rooms', type=int, default=20)
+    parser.add_argument('--watchers', type=int, default=10,
+                        help='users having a watch (set up first)')
+    parser.add_argument('--ooo', type=int, default=5,
+                        help='users being out of office (set up first)')
+    parser.add_argument('--rate', type=float, default=20.0,
+                        help='events per second')
+    parser.add_argument('--duration', type=float, default=30.0,
+                        help='seconds of load')
+    parser.add_argument('--settle', type=float, default=2.0,
+                        help='seconds between set-up and load')
+    parser.add_argument('--drain', type=float, default=5.0,
+                        help='seconds to wait for replies after the load')
+    parser.add_argument('--command-rate', type=float, default=0.05)
+    parser.add_argument('--watch-rate', type=float, default=0.05)
+    parser.add_argument('--mention-rate', type=float, default=0.1)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='ms added to pod and message calls')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='random ms added on top of --latency')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='share of pod and message calls failing')
+    parser.add_argument('--error-status', type=int, default=503)
+    parser.add_argument('--poll', type=float, default=1.0,
+                        help='seconds a datafeed read waits for events')
+    parser.add_argument('--record', metavar='FILE',
+                        help='write the messages sent by the bot (JSONL)')
+    parser.add_argument('--spawn', action='store_true',
+                        help='start sidekick.py against the stand-in')
+    parser.add_argument('--seed', type=int, default=None)
+    opts = parser.parse_args()
+    random.seed(opts.seed)
+
+    world = World(opts.users, opts.rooms, min(opts.watchers, opts.users),
+                  min(opts.ooo, max(0, opts.users - opts.watchers)))
+    stats = Stats()
+    httpd = StandinServer(('localhost', opts.port), StandinHandler)
+    httpd.opts = opts
+    httpd.world = world
+    httpd.stats = stats
+    httpd.traffic = Traffic(world, stats, opts)
+    httpd.record = open(opts.record, 'w') if opts.record else None
+    t = threading.Thread(target=httpd.serve_forever, name='standin')
+    t.daemon = True
+    t.start()
+    url = 'http://localhost:%d/' % httpd.server_address[1]
+    print ">> stand-in listening on %s" % url
+
+    bot = None
+    if opts.spawn:
+        bot, home = spawn_bot(url)
+        print ">> started sidekick.py (pid %d, HOME=%s)" % (bot.pid, home)
+    try:
+        while not httpd.traffic.done.wait(1.0):
+            if bot and bot.poll() is not None:
+                print ">> sidekick.py exited with %d" % bot.returncode
+                break
+        time.sleep(opts.drain)
+    except KeyboardInterrupt:
+        pass
+    stats.report(opts.duration)
+    if bot and bot.poll() is None:
+        bot.terminate()
+        bot.wait()
+        shutil.rmtree(home)
+    if httpd.record:
+        httpd.record.close()
+    httpd.shutdown()
+
+if __name__ == '__main__':
+    main()
+
+# eof
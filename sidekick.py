@@ -35,136 +35,526 @@
     includes demo code of <matt.joyce@symphony.com>
 '''
 
+import argparse
+import atexit
+import BaseHTTPServer
 import binascii
 import base64
+import bisect
 from   bs4 import BeautifulSoup, element
+import calendar
+import collections
+import cProfile
 from   datetime import datetime, time, timedelta
+import gzip
+import heapq
+import itertools
 import json
+import multiprocessing
 import os
+import pstats
+import Queue
 import random
 import pytz
 import pytz.reference
 import re
 import requests
+import shutil
 import socket
+import sqlite3
+import StringIO
 import sys
+import tempfile
+import threading
+import time as _time
 import urllib2
+import xml.parsers.expat
 import yaml
+import zlib
 
 
 # API endpoint URI
 __url__      = 'https://corporate-api.symphony.com:8444/'
 __cert__     = ('cert/certificate.pem', 'cert/plainkey.pem')
+__pool__     = 8        # max. keep-alive connections per pool (pod, agent)
+__keepalive__ = True
 
 # misc
 __SIDEKICK_VERSION__ = "0.1"
 __SERVER_TIMEZONE__  = "US/Pacific"
 
+# stream types (as reported by the pod) which we treat as private chats
+IM_STREAM_TYPES = ['IM', 'MIM']
+
 # limitation for testing (only react to commands if from this room)
 # __TESTROOM__  = 'B7jT5tKwCmVffN0jidhhOn___qnxnQYhdA'
 
 # ---------------------------------------------------------------------------
 
+class Metrics:
+    '''
+    counters, gauges and histograms, keyed by name and labels, rendered
+    as Prometheus text. Histograms have fixed buckets: an observation
+    is a bisect and two additions under a lock, cheap enough to leave
+    on for every event. Gauges are functions, called when rendering.
+    '''
+
+    TIME = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+            0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]      # seconds
+    SIZE = [0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.kinds = {}         # name -> (type, help, buckets)
+        self.values = {}        # (name, labels) -> count, or histogram:
+                                #   [ n per bucket ..., n above, sum ]
+        self.gauges = {}        # (name, labels) -> fn
+
+    def counter(self, name, help):
+        self.kinds[name] = ('counter', help, None)
+
+    def histogram(self, name, help, buckets=TIME):
+        self.kinds[name] = ('histogram', help, buckets)
+
+    def gauge(self, name, help, fn, **labels):
+        self.kinds[name] = ('gauge', help, None)
+        self.gauges[(name, tuple(sorted(labels.items())))] = fn
+
+    def key(self, name, **labels):
+        # a series, for add() on hot paths
+        return (name, tuple(sorted(labels.items())))
+
+    def inc(self, name, n=1, **labels):
+        self.add((name, tuple(sorted(labels.items()))), n)
+
+    def add(self, key, n=1):
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + n
+
+    def observe(self, name, v, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        buckets = self.kinds[name][2]
+        i = bisect.bisect_left(buckets, v)
+        with self.lock:
+            h = self.values.get(key)
+            if h is None:
+                h = self.values[key] = [0] * (len(buckets) + 1) + [0.0]
+            h[i] += 1
+            h[-1] += v
+
+    def _series(self):
+        # [ (name, labels, value) ], sorted; gauges that fail are left out
+        with self.lock:
+            lst = [ (k[0], k[1], v if type(v) != list else list(v))
+                    for k, v in self.values.iteritems() ]
+        for key, fn in self.gauges.items():
+            try:
+                lst.append((key[0], key[1], fn()))
+            except Exception:
+                pass
+        lst.sort()
+        return lst
+
+    def _labels(self, labels, extra=()):
+        labels = list(labels) + list(extra)
+        if len(labels) == 0:
+            return ''
+        return '{' + ','.join(['%s="%s"' % (k, str(v).replace('"', '\\"'))
+                               for k, v in labels]) + '}'
+
+    def render(self):
+        out = []
+        last = None
+        for name, labels, v in self._series():
+            kind, help, buckets = self.kinds[name]
+            if not name == last:
+                out.append('# HELP %s %s' % (name, help))
+                out.append('# TYPE %s %s' % (name, kind))
+                last = name
+            if kind != 'histogram':
+                out.append('%s%s %s' % (name, self._labels(labels), v))
+                continue
+            n = 0
+            for le, c in zip(buckets + ['+Inf'], v[:-1]):
+                n += c
+                out.append('%s_bucket%s %d' % (name, self._labels(labels,
+                                               [('le', le)]), n))
+            out.append('%s_sum%s %s' % (name, self._labels(labels), v[-1]))
+            out.append('%s_count%s %d' % (name, self._labels(labels), n))
+        return '\n'.join(out) + '\n'
+
+    def _quantile(self, buckets, v, q):
+        # upper bound of the bucket holding the q-quantile
+        n = sum(v[:-1])
+        acc = 0
+        for le, c in zip(buckets + [None], v[:-1]):
+            acc += c
+            if acc >= q * n:
+                return le
+        return None
+
+    def summary(self):
+        # short text version, for the chat: times in ms
+        lines = []
+        for name, labels, v in self._series():
+            kind, help, buckets = self.kinds[name]
+            s = name.replace('sidekick_', '', 1) + self._labels(labels)
+            if kind != 'histogram':
+                lines.append("%s: %s" % (s, v))
+                continue
+            n = sum(v[:-1])
+            if n == 0:
+                continue
+            f, unit = (1000.0, 'ms') if buckets is self.TIME else (1, '')
+            p = [ self._quantile(buckets, v, q) for q in [0.5, 0.99] ]
+            p = [ ">%s%s" % (buckets[-1] * f, unit) if x is None else
+                  "<=%s%s" % (x * f, unit) for x in p ]
+            lines.append("%s: n=%d mean=%.1f%s p50%s p99%s" %
+                         (s, n, v[-1] / n * f, unit, p[0], p[1]))
+        return '\n'.join(lines)
+
+metrics = Metrics()
+metrics.histogram('sidekick_datafeed_read_seconds',
+                  'duration of a datafeed read (long poll)')
+metrics.histogram('sidekick_datafeed_read_events',
+                  'events per datafeed read', Metrics.SIZE)
+metrics.histogram('sidekick_handler_seconds',
+                  'time spent per event and handler stage')
+metrics.histogram('sidekick_job_seconds', 'run time of scheduled jobs')
+metrics.histogram('sidekick_shard_seconds',
+                  'time from handing a batch to the shards to its results')
+metrics.histogram('sidekick_rest_seconds', 'REST call latency')
+metrics.counter('sidekick_rest_errors_total', 'failed REST calls')
+metrics.histogram('sidekick_outbound_wait_seconds',
+                  'time from queueing a message to sending it')
+metrics.counter('sidekick_outbound_messages_total',
+                'messages (after coalescing) sent or failed')
+metrics.histogram('sidekick_store_sync_seconds', 'duration of store syncs')
+metrics.counter('sidekick_cache_lookups_total', 'cache lookups')
+metrics.gauge('sidekick_outbound_queue_depth', 'messages waiting to be sent',
+              lambda: outq.qsize())
+metrics.gauge('sidekick_store_bytes', 'size of the store on disk',
+              lambda: SKS.size())
+metrics.gauge('sidekick_store_pending_changes', 'changes not yet synced',
+              lambda: len(SKS.pending))
+metrics.gauge('sidekick_user_cache_size', 'users in the user cache',
+              lambda: len(userdir.cache))
+
+def rest_metric(endpoint):
+    # decorator timing a REST call, and counting the ones that raise
+    def wrap(fn):
+        def timed(*args, **kwargs):
+            t0 = _time.time()
+            try:
+                return fn(*args, **kwargs)
+            except Exception, details:
+                code = getattr(details, 'status_code', type(details).__name__)
+                metrics.inc('sidekick_rest_errors_total', endpoint=endpoint,
+                            code=code)
+                raise
+            finally:
+                metrics.observe('sidekick_rest_seconds', _time.time() - t0,
+                                endpoint=endpoint)
+        timed.__name__ = fn.__name__
+        timed.__doc__ = fn.__doc__
+        return timed
+    return wrap
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if not self.path.split('?')[0] == '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def serve_metrics(port):
+    # Prometheus endpoint on localhost:port/metrics, on its own thread
+    httpd = BaseHTTPServer.HTTPServer(('127.0.0.1', port), MetricsHandler)
+    t = threading.Thread(target=httpd.serve_forever, name='metrics')
+    t.daemon = True
+    t.start()
+    return httpd
+
+# ---------------------------------------------------------------------------
+
+class RESTError(Exception):
+
+    def __init__(self, endpoint, r):
+        Exception.__init__(self, " REST(%s): %s" % (endpoint, str(r)))
+        self.status_code = r.status_code
+
+    def is_transient(self):
+        return self.status_code/100 == 5 or self.status_code == 429
+
 class SymphonyBridge:
+    '''
+    REST calls towards the pod and the agent, each over its own pool of
+    keep-alive connections (requests.Session with the client certs).
+    All calls time out, but for the datafeed read (a long poll), which
+    only has the connect timeout.
+    '''
+
+    TIMEOUT = (10, 30)          # seconds to connect, and to wait for data
 
-    def __init__(self, url, certs):
+    def __init__(self, url, certs, pool_size=8, keepalive=True, verify=True):
         self.url = url
         self.certs = certs
-        r = requests.post(self.url + 'sessionauth/v1/authenticate',
-                          cert=self.certs, verify=True)
+        self.pod = self._session(pool_size, keepalive, verify)
+        self.agent = self._session(pool_size, keepalive, verify)
+        r = self.pod.post(self.url + 'sessionauth/v1/authenticate',
+                          timeout=self.TIMEOUT)
         if not r.status_code == 200:
-            raise Exception(" REST(sessionauth): %s" % str(r))
+            raise RESTError('sessionauth', r)
         self.sessionToken = r.json()['token']
-        r = requests.post(self.url + 'keyauth/v1/authenticate',
-                          cert=self.certs, verify=True)
+        r = self.agent.post(self.url + 'keyauth/v1/authenticate',
+                            timeout=self.TIMEOUT)
         if not r.status_code == 200:
-            raise Exception(" REST(keyauth): %s" % str(r))
+            raise RESTError('keyauth', r)
         self.keymngrToken = r.json()['token']
+        self.pod.headers['sessionToken'] = self.sessionToken
+        self.agent.headers['sessionToken'] = self.sessionToken
+        self.agent.headers['keyManagerToken'] = self.keymngrToken
+
+    def _session(self, pool_size, keepalive, verify):
+        s = requests.Session()
+        s.cert = self.certs
+        s.verify = verify
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=pool_size)
+        s.mount('https://', adapter)
+        s.mount('http://', adapter)
+        if not keepalive:
+            s.headers['Connection'] = 'close'
+        return s
 
     def _request_or_except(self, endpoint):
-        r = requests.get(self.url + endpoint, cert=self.certs, verify=True,
-                          headers = {'sessionToken': self.sessionToken})
+        r = self.pod.get(self.url + endpoint, timeout=self.TIMEOUT)
         if not r.status_code == 200:
-            raise Exception(" REST(%s): %s" % (endpoint, str(r)))
+            raise RESTError(endpoint, r)
         return r
 
+    @rest_metric('pod/v1/sessioninfo')
     def get_my_id(self):
         r = self._request_or_except('pod/v1/sessioninfo')
         return str(r.json()['userId'])
 
-    def get_user_email(self, uid):
-        r = self._request_or_except('pod/v1/admin/user/' + uid)
-        return r.json()['userAttributes']['emailAddress']
-
-    def get_user_name(self, uid):
-        r = requests.get(self.url + 'pod/v1/admin/user/' + uid,
-                         cert=self.certs, verify=True,
-                         headers = {'sessionToken': self.sessionToken})
+    @rest_metric('pod/v1/admin/user')
+    def get_user_info(self, uid):
+        # a user's attributes, or None if we may not see them (4xx)
+        r = self.pod.get(self.url + 'pod/v1/admin/user/' + uid,
+                         timeout=self.TIMEOUT)
         if r.status_code/100 == 4:
-            return "[uid=%s]" % uid
+            return None
+        if not r.status_code == 200:
+            raise RESTError('pod/v1/admin/user/', r)
+        return r.json()['userAttributes']
+
+    @rest_metric('pod/v3/users')
+    def get_users(self, uids):
+        # attributes for many users in one call: { uid : attrs or None }
+        r = self.pod.get(self.url + 'pod/v3/users',
+                         params={'uid': ','.join(uids), 'local': 'true'},
+                         timeout=self.TIMEOUT)
         if not r.status_code == 200:
-            raise Exception(" REST(%s): %s" % ('pod/v1/admin/user/', str(r)))
-        return r.json()['userAttributes']['displayName']
-
-    def get_room_name(self, sid):
-        return "[sid=%s]" % sid
-        r = requests.get(self.url + 'pod/v2/room/' + sid + '/info',
-                         cert=self.certs, verify=True,
-                         headers = {'sessionToken': self.sessionToken})
+            raise RESTError('pod/v3/users', r)
+        found = {}
+        for u in r.json().get('users', []):
+            found[str(u['id'])] = u
+        return dict([ (uid, found.get(uid)) for uid in uids ])
+
+    @rest_metric('pod/v2/room/info')
+    def get_room_info(self, sid):
+        r = self.pod.get(self.url + 'pod/v2/room/' + sid + '/info',
+                         timeout=self.TIMEOUT)
         if r.status_code/100 == 4:
-            return "[sid=%s]" % sid
+            return None
+        if not r.status_code == 200:
+            raise RESTError('pod/v2/room/', r)
+        return r.json()
+
+    @rest_metric('pod/v2/room/membership/list')
+    def get_room_members(self, sid):
+        r = self.pod.get(self.url + 'pod/v2/room/' + sid + '/membership/list',
+                         timeout=self.TIMEOUT)
+        if r.status_code/100 == 4:
+            return None
         if not r.status_code == 200:
-            raise Exception(" REST(%s): %s" % ('pod/v2/room/', str(r)))
-        return r.json()['roomAttributes']['name']
+            raise RESTError('pod/v2/room/', r)
+        return r.json()
 
+    @rest_metric('pod/v1/im/create')
     def get_user_IM(self, uid):
-        r = requests.post(self.url + 'pod/v1/im/create',
-                          cert=self.certs, verify=True,
-                          headers = {'sessionToken': self.sessionToken,
-                                     'Content-Type': 'application/json'},
-                          data = json.dumps( [ int(uid) ] ))
+        r = self.pod.post(self.url + 'pod/v1/im/create',
+                          headers = {'Content-Type': 'application/json'},
+                          data = json.dumps( [ int(uid) ] ),
+                          timeout=self.TIMEOUT)
         if not r.status_code == 200:
-            raise Exception(" REST(%s): %s" % ('pod/v1/im/create', str(r)))
+            raise RESTError('pod/v1/im/create', r)
         return r.json()['id']
 
+    @rest_metric('pod/v1/streams/info')
+    def get_stream_info(self, sid):
+        r = self.pod.get(self.url + 'pod/v1/streams/' + sid + '/info',
+                         timeout=self.TIMEOUT)
+        if r.status_code/100 == 4:
+            return None
+        if not r.status_code == 200:
+            raise RESTError('pod/v1/streams/', r)
+        return r.json()
+
+    @rest_metric('agent/v1/datafeed/create')
     def create_datafeed(self):
-        headers = {'Content-Type': 'application/json',
-                   'sessionToken': self.sessionToken,
-                   'keyManagerToken': self.keymngrToken}
-        r = requests.post(self.url + 'agent/v1/datafeed/create',
-                          headers=headers, cert=self.certs, verify=True)
+        headers = {'Content-Type': 'application/json'}
+        r = self.agent.post(self.url + 'agent/v1/datafeed/create',
+                            headers=headers, timeout=self.TIMEOUT)
         if not r.status_code == 200:
-            raise Exception(" REST(%s): %s" % ('datafeed/create', str(r)))
+            raise RESTError('datafeed/create', r)
         return r.json()['id']
 
+    @rest_metric('agent/v2/datafeed/read')
     def read_datafeed(self, streamid):
-        headers = {'Content-Type': 'application/json',
-                   'sessionToken': self.sessionToken,
-                   'keyManagerToken': self.keymngrToken}
-        r = requests.get(self.url + 'agent/v2/datafeed/' + str(streamid) + '/read',
-                         headers=headers, cert=self.certs, verify=True)
+        headers = {'Content-Type': 'application/json'}
+        r = self.agent.get(self.url + 'agent/v2/datafeed/' + str(streamid) + \
+                           '/read', headers=headers,
+                           timeout=(self.TIMEOUT[0], None))
         if not r.status_code/100 == 2:
-            raise Exception(" REST(%s): %s" % ('datafeed/read', str(r)))
+            raise RESTError('datafeed/read', r)
         return r.text
 
+    @rest_metric('agent/v2/stream/message/create')
     def send_message(self, streamid, msgFormat, message, attachments=None):
-        headers = {'content-type': 'application/json',
-                   'sessionToken': self.sessionToken,
-                   'keyManagerToken': self.keymngrToken}
+        headers = {'content-type': 'application/json'}
         data = { 'format': msgFormat, 'message': message }
         if attachments:
             data['attachments'] = attachments
-        r = requests.post(self.url + 'agent/v2/stream/' + streamid + \
-                          '/message/create',
-                          headers=headers, data=json.dumps(data),
-                          cert=self.certs, verify=True)
+        r = self.agent.post(self.url + 'agent/v2/stream/' + streamid + \
+                            '/message/create',
+                            headers=headers, data=json.dumps(data),
+                            timeout=self.TIMEOUT)
         if not r.status_code == 200:
-            raise Exception(" REST(%s): %s" % ('message/create', str(r)))
+            raise RESTError('message/create', r)
         return r.text
 
 # ---------------------------------------------------------------------------
 
+class SnapshotManager:
+    '''
+    backups of the store file: snapshot N is a hard link to the store
+    file (or the given one) at the time of take(), gzipped when N+1 is
+    taken. The index
+    file lists the snapshots (one JSON line each) and is read once, so
+    a save costs the same few file operations however many we keep.
+    '''
+
+    KEEP    = 50                # prune beyond this many snapshots,
+    MAX_AGE = 30 * 24 * 3600    # or when older than this (seconds)
+
+    def __init__(self, storeFN):
+        self.storeFN = storeFN
+        self.dir = os.path.dirname(storeFN) + '/snapshots'
+        self.indexFN = self.dir + '/index'
+        self.base = self.dir + '/' + os.path.basename(storeFN)
+        self.index = None       # [ {'n':, 'time':, 'file':} ], oldest first
+
+    def _load(self):
+        if self.index is not None:
+            return
+        self.index = []
+        if not os.path.exists(self.dir):
+            os.makedirs(self.dir)
+            os.chmod(self.dir, 0o700)
+        if os.path.exists(self.indexFN):
+            with open(self.indexFN, 'r') as f:
+                for line in f:
+                    try:
+                        self.index.append(json.loads(line))
+                    except ValueError: # torn write at the end
+                        break
+
+    def _write_index(self):
+        with open(self.indexFN + '.tmp', 'w') as f:
+            for s in self.index:
+                f.write(json.dumps(s) + '\n')
+        os.rename(self.indexFN + '.tmp', self.indexFN)
+
+    def take(self, src=None):
+        # snapshot the store file, or src (a complete store file)
+        self._load()
+        src = src or self.storeFN
+        if not os.path.exists(src):
+            return None
+        n = self.index[-1]['n'] + 1 if self.index else 1
+        fn = self.base + '.%d' % n
+        try:
+            os.link(src, fn)
+        except OSError: # no hard links on this file system
+            shutil.copy2(src, fn)
+        snap = { 'n' : n, 'time' : _time.time(), 'file' : fn }
+        if self.index:
+            self._compress(self.index[-1])
+        self.index.append(snap)
+        now = _time.time()
+        while len(self.index) > self.KEEP or \
+              (len(self.index) > 1 and \
+               now - self.index[0]['time'] > self.MAX_AGE):
+            old = self.index.pop(0)
+            if os.path.exists(old['file']):
+                os.unlink(old['file'])
+        self._write_index()
+        return snap
+
+    def _compress(self, snap):
+        if snap['file'].endswith('.gz') or not os.path.exists(snap['file']):
+            return
+        with open(snap['file'], 'rb') as fin:
+            with gzip.open(snap['file'] + '.gz', 'wb') as fout:
+                shutil.copyfileobj(fin, fout)
+        os.chmod(snap['file'] + '.gz', 0o600)
+        os.unlink(snap['file'])
+        snap['file'] += '.gz'
+
+    def list(self):
+        self._load()
+        return list(self.index)
+
+    def copy(self, n, dst):
+        # write snapshot n to file dst, returns False if unknown
+        self._load()
+        for snap in self.index:
+            if snap['n'] == n:
+                break
+        else:
+            return False
+        if snap['file'].endswith('.gz'):
+            fin = gzip.open(snap['file'], 'rb')
+        else:
+            fin = open(snap['file'], 'rb')
+        with fin:
+            with open(dst, 'wb') as fout:
+                shutil.copyfileobj(fin, fout)
+        os.chmod(dst, 0o600)
+        return True
+
 class SidekickStore:
+    '''
+    the bot's state: a JSON snapshot plus an append-only journal of
+    the changes made since. Changes done via setVal/appendVal/delVal are
+    journaled (cheap to sync), other changes need to set 'dirty', which
+    makes the next sync write a new snapshot.
+    '''
+
+    JOURNAL_MAX = 1 << 20       # compact once the journal is this big,
+    JOURNAL_AGE = 3600          # or has not been compacted for this long
+    COMMIT_AGE  = 1.0           # max. seconds a journaled change waits
 
     def __init__(self):
         self.cacheFN = os.environ['HOME'] + '/.symphony'
@@ -172,13 +562,38 @@ class SidekickStore:
             os.makedirs(self.cacheFN)
         os.chmod(self.cacheFN, 0o700)
         self.cacheFN += '/sidekick-store.json'
+        self.journalFN = self.cacheFN + '.journal'
+        self.snapshots = SnapshotManager(self.cacheFN)
         self.data = None           # root dir of our data tree 
         self.dirty = False
         self.saved = False
+        self.ims = {}              # IM streamId -> uid (None if unknown)
+        self.lock = threading.RLock() # held while reading/changing data
+        self.seq = 0               # number of the last journal record
+        self.pending = []          # journal records not yet written
+        self.pendingSince = None
+        self.journalSize = 0
+        self.compacted = _time.time()
 
     def reset(self):
-        if os.path.exists(self.cacheFN):
-            os.unlink(self.cacheFN)
+        for fn in [self.cacheFN, self.journalFN]:
+            if os.path.exists(fn):
+                os.unlink(fn)
+
+    def restore(self, n):
+        # go back to snapshot n, dropping the journal of later changes;
+        # the current state, journal included, becomes a snapshot first
+        fn = self.cacheFN + '.restore'
+        if not self.snapshots.copy(n, fn):
+            return False
+        if os.path.exists(self.cacheFN) or os.path.exists(self.journalFN):
+            self.load()
+            if not self.saved:
+                self._snapshot(backup=True)
+        os.rename(fn, self.cacheFN)
+        if os.path.exists(self.journalFN):
+            os.unlink(self.journalFN)
+        return True
 
     def load(self):
         if os.path.exists(self.cacheFN):
@@ -189,22 +604,129 @@ class SidekickStore:
             self.data = {}
             self.dirty = True
         self.saved = False
+        self.seq = self.data.get('sidekick.journal.seq', 0)
+        seq = self.seq
+        self._replay()
+        self.index_ims()
+        if self.seq > seq:
+            # compact the previous run's journal now: the snapshot of
+            # the state we start from has to include it
+            self._snapshot(backup=True)
+
+    def index_ims(self):
+        # reverse index of the cached IMs, plus streams known to be IMs
+        self.ims = {}
+        if 'config' in self.data:
+            types = self.data['config'].get('streamTypes', {})
+            for sid in types:
+                if types[sid] in IM_STREAM_TYPES:
+                    self.ims[sid] = None
+        for uid, u in self.data.get('user', {}).iteritems():
+            if 'im' in u:
+                self.ims[u['im']] = uid
+
+    def _replay(self):
+        self.journalSize = 0
+        if not os.path.exists(self.journalFN):
+            return
+        good = 0
+        with open(self.journalFN, 'r') as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError: # torn write at the end of the journal
+                    break
+                good += len(line)
+                if rec[0] <= self.seq: # already part of the snapshot
+                    continue
+                self._apply(rec[1], rec[2], rec[3])
+                self.seq = rec[0]
+        if good < os.path.getsize(self.journalFN):
+            with open(self.journalFN, 'r+') as f:
+                f.truncate(good)
+        self.journalSize = good
+
+    def _apply(self, op, path, val):
+        node = self.data
+        for k in path[:-1]:
+            node = node[k]
+        if op == 'set':
+            node[path[-1]] = val
+        elif op == 'add':
+            node[path[-1]].append(val)
+        elif op == 'del':
+            del node[path[-1]]
+
+    def _record(self, op, path, val=None):
+        self.seq += 1
+        # serialize now: val may change later, journaled by its own record
+        self.pending.append(json.dumps([self.seq, op, path, val]))
+        if self.pendingSince is None:
+            self.pendingSince = _time.time()
+
+    def setVal(self, path, val):
+        self._apply('set', path, val)
+        self._record('set', path, val)
+
+    def appendVal(self, path, val):
+        self._apply('add', path, val)
+        self._record('add', path, val)
+
+    def delVal(self, path):
+        self._apply('del', path, None)
+        self._record('del', path)
+
+    def commit_due(self):
+        return self.pendingSince is not None and \
+               _time.time() - self.pendingSince >= self.COMMIT_AGE
+
+    def size(self):
+        # bytes on disk: snapshot plus journal
+        return os.path.getsize(self.cacheFN) + self.journalSize
 
     def sync(self):
-        if not self.dirty:
+        t0 = _time.time()
+        if self.dirty or self.journalSize > self.JOURNAL_MAX or \
+           (self.journalSize > 0 and \
+            _time.time() - self.compacted > self.JOURNAL_AGE):
+            self._snapshot()
+            metrics.observe('sidekick_store_sync_seconds',
+                            _time.time() - t0, kind='snapshot')
             return
+        if len(self.pending) == 0:
+            return
+        # group commit: all changes since the last sync, one write+fsync
+        buf = '\n'.join(self.pending) + '\n'
+        with open(self.journalFN, 'a') as f:
+            f.write(buf)
+            f.flush()
+            os.fsync(f.fileno())
+        if self.journalSize == 0:
+            os.chmod(self.journalFN, 0o600)
+        self.journalSize += len(buf)
+        self.pending = []
+        self.pendingSince = None
+        metrics.observe('sidekick_store_sync_seconds', _time.time() - t0,
+                        kind='journal')
+
+    def _snapshot(self, backup=False):
+        # backup: the data is the state this run started from
+        self.data['sidekick.journal.seq'] = self.seq
         with open(self.cacheFN + '.tmp', 'w') as f:
             json.dump(self.data, f)
+            f.flush()
+            os.fsync(f.fileno())
         os.chmod(self.cacheFN + '.tmp', 0o600)
-        if not self.saved:
-            for n in range(0, 50):
-                i = 50 - n
-                if os.path.exists(self.cacheFN + '~' + str(i)):
-                    os.rename(self.cacheFN + '~' + str(i),
-                              self.cacheFN + '~' + str(i+1))
-            if os.path.exists(self.cacheFN):
-                os.rename(self.cacheFN, self.cacheFN + '~1')
+        if not self.saved: # keep the state this run started from
+            self.snapshots.take(self.cacheFN + '.tmp' if backup else None)
         os.rename(self.cacheFN + '.tmp', self.cacheFN)
+        # the snapshot covers all records up to self.seq, so a crash
+        # before the truncation below is harmless (see _replay)
+        open(self.journalFN, 'w').close()
+        self.journalSize = 0
+        self.pending = []
+        self.pendingSince = None
+        self.compacted = _time.time()
         self.saved = True
         self.dirty = False
 
@@ -217,8 +739,1049 @@ class SidekickStore:
         return None
 
     def config_setVal(self, name, val):
-        self.data['config'][name] = val
-        self.dirty = True
+        self.setVal(['config', name], val)
+
+    def ooo_entries(self, uid, sid):
+        # [ (pos, entry) ] of uid's OOO entries for room sid (or all rooms)
+        if not uid in self.data['user']:
+            return []
+        return [ (i, o) for i, o in enumerate(self.data['user'][uid]['ooo'])
+                                              if o['stream'] in [sid, '*'] ]
+
+class SidekickSQLiteStore(SidekickStore):
+    '''
+    SidekickStore backed by SQLite: per-user state lives in indexed
+    tables. setVal/appendVal/delVal write the affected rows through
+    (one user's watch list, one stream, ...) and sync() commits. The
+    in-memory data tree is the same as with the JSON store.
+    '''
+
+    SCHEMA = '''
+      CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+      CREATE TABLE IF NOT EXISTS config (key TEXT PRIMARY KEY, value TEXT);
+      CREATE TABLE IF NOT EXISTS streams (sid TEXT PRIMARY KEY,
+                          member INTEGER NOT NULL DEFAULT 0, type TEXT,
+                          room TEXT);
+      CREATE TABLE IF NOT EXISTS users (uid TEXT PRIMARY KEY,
+                          im TEXT, email TEXT, displayName TEXT, attrs TEXT);
+      CREATE INDEX IF NOT EXISTS users_im ON users (im);
+      CREATE TABLE IF NOT EXISTS aliases (uid TEXT, pos INTEGER,
+                          trigger TEXT, expansion TEXT,
+                          PRIMARY KEY (uid, pos));
+      CREATE INDEX IF NOT EXISTS aliases_trigger ON aliases (trigger);
+      CREATE TABLE IF NOT EXISTS watches (uid TEXT, pos INTEGER,
+                          stream TEXT, regex TEXT, entry TEXT,
+                          PRIMARY KEY (uid, pos));
+      CREATE INDEX IF NOT EXISTS watches_stream ON watches (stream);
+      CREATE TABLE IF NOT EXISTS announcements (uid TEXT, pos INTEGER,
+                          stream TEXT, entry TEXT,
+                          PRIMARY KEY (uid, pos));
+      DROP INDEX IF EXISTS announcements_due;
+      CREATE TABLE IF NOT EXISTS ooo (uid TEXT, pos INTEGER,
+                          stream TEXT, till REAL, entry TEXT,
+                          PRIMARY KEY (uid, pos));
+      CREATE INDEX IF NOT EXISTS ooo_uid_stream ON ooo (uid, stream);
+    '''
+
+    # per-user lists with a table of their own
+    SECTIONS = { 'alias': 'aliases', 'announce': 'announcements',
+                 'ooo': 'ooo', 'watch': 'watches' }
+    # their columns (older databases may have more)
+    COLUMNS = { 'alias': 'uid, pos, trigger, expansion',
+                'announce': 'uid, pos, stream, entry',
+                'ooo': 'uid, pos, stream, till, entry',
+                'watch': 'uid, pos, stream, regex, entry' }
+
+    def __init__(self):
+        SidekickStore.__init__(self)
+        self.dbFN = os.path.splitext(self.cacheFN)[0] + '.sqlite'
+        self.db = None
+
+    def reset(self):
+        if os.path.exists(self.dbFN):
+            os.unlink(self.dbFN)
+
+    def load(self):
+        isNew = not os.path.exists(self.dbFN)
+        self.db = sqlite3.connect(self.dbFN, check_same_thread=False)
+        os.chmod(self.dbFN, 0o600)
+        self.db.executescript(self.SCHEMA)
+        if not 'room' in [ c[1] for c in
+                           self.db.execute('PRAGMA table_info(streams)') ]:
+            self.db.execute('ALTER TABLE streams ADD COLUMN room TEXT')
+        self.data = {}
+        for k, v in self.db.execute('SELECT key, value FROM meta'):
+            self.data[k] = json.loads(v)
+        if not isNew:
+            self.data['config'] = {}
+            for k, v in self.db.execute('SELECT key, value FROM config'):
+                self.data['config'][k] = json.loads(v)
+            self.data['config']['myStreamIDs'] = [ sid for (sid,) in
+                  self.db.execute('SELECT sid FROM streams WHERE member = 1 '
+                                  'ORDER BY rowid') ]
+            self.data['config']['streamTypes'] = dict(
+                  self.db.execute('SELECT sid, type FROM streams '
+                                  'WHERE type IS NOT NULL'))
+            self.data['user'] = {}
+            for uid, attrs in self.db.execute('SELECT uid, attrs FROM users'):
+                u = json.loads(attrs)
+                for n in self.SECTIONS:
+                    u[n] = []
+                u['alias'] = {}
+                self.data['user'][uid] = u
+            for uid, s1, s2 in self.db.execute('SELECT uid, trigger, '
+                            'expansion FROM aliases'):
+                self.data['user'][uid]['alias'][s1] = s2
+            for n in ['announce', 'ooo', 'watch']:
+                for uid, entry in self.db.execute('SELECT uid, entry FROM ' +
+                                  self.SECTIONS[n] + ' ORDER BY uid, pos'):
+                    self.data['user'][uid][n].append(json.loads(entry))
+        # older databases keep the rooms as one meta value: the first
+        # sync moves them to their rows
+        moved = 'rooms' in self.data
+        if not moved:
+            self.data['rooms'] = dict([ (sid, json.loads(room)) for
+                  (sid, room) in self.db.execute('SELECT sid, room FROM '
+                                       'streams WHERE room IS NOT NULL') ])
+        self.dirty = isNew or moved
+        self.saved = False
+        self.pending = []
+        self.pendingSince = None
+        self.index_ims()
+
+    def _record(self, op, path, val=None):
+        # write the affected rows now, sync() commits them
+        self.pending.append(op)
+        if self.pendingSince is None:
+            self.pendingSince = _time.time()
+        if path[0] == 'user':
+            if len(path) == 1:
+                self._write_users()
+            elif len(path) == 2 or not path[1] in self.data['user']:
+                self._write_user(path[1])
+            elif path[2] in self.SECTIONS:
+                self._write_section(path[1], path[2])
+            else:
+                self._write_user_row(path[1])
+        elif path[0] == 'config':
+            if len(path) == 1:
+                self._write_config()
+            elif path[1] == 'myStreamIDs' and op == 'add':
+                self._write_stream(val)
+            elif path[1] == 'streamTypes' and len(path) == 3:
+                self._write_stream(path[2])
+            elif path[1] in ['myStreamIDs', 'streamTypes']:
+                self._write_streams()
+            else:
+                self._write_config_key(path[1])
+        elif path[0] == 'rooms':
+            if len(path) == 1:
+                self._write_streams()
+            else:
+                self._write_room(path[1])
+        else:
+            self._write_meta(path[0])
+
+    def _write_meta(self, key):
+        self.db.execute('DELETE FROM meta WHERE key = ?', (key,))
+        if key in self.data:
+            self.db.execute('INSERT INTO meta VALUES (?, ?)',
+                            (key, json.dumps(self.data[key])))
+
+    def _write_config_key(self, key):
+        self.db.execute('DELETE FROM config WHERE key = ?', (key,))
+        if key in self.data['config']:
+            self.db.execute('INSERT INTO config VALUES (?, ?)',
+                            (key, json.dumps(self.data['config'][key])))
+
+    def _write_config(self):
+        self.db.execute('DELETE FROM config')
+        for key in self.data.get('config', {}):
+            if not key in ['myStreamIDs', 'streamTypes']:
+                self._write_config_key(key)
+        self._write_streams()
+
+    def _write_stream(self, sid):
+        config = self.data['config']
+        self.db.execute('INSERT OR IGNORE INTO streams (sid) VALUES (?)',
+                        (sid,))
+        self.db.execute('UPDATE streams SET member = ?, type = ? '
+                        'WHERE sid = ?',
+                        (int(sid in config.get('myStreamIDs', [])),
+                         config.get('streamTypes', {}).get(sid), sid))
+
+    def _write_room(self, sid):
+        room = self.data.get('rooms', {}).get(sid)
+        self.db.execute('INSERT OR IGNORE INTO streams (sid) VALUES (?)',
+                        (sid,))
+        self.db.execute('UPDATE streams SET room = ? WHERE sid = ?',
+                        (json.dumps(room) if room else None, sid))
+
+    def _write_streams(self):
+        self.db.execute('DELETE FROM streams')
+        config = self.data.get('config', {})
+        for sid in config.get('myStreamIDs', []):
+            self._write_stream(sid)
+        for sid in config.get('streamTypes', {}):
+            self._write_stream(sid)
+        for sid in self.data.get('rooms', {}):
+            self._write_room(sid)
+
+    def _write_user_row(self, uid):
+        u = self.data['user'][uid]
+        attrs = dict([ (k, u[k]) for k in u if not k in self.SECTIONS ])
+        self.db.execute('INSERT OR REPLACE INTO users VALUES (?,?,?,?,?)',
+                        (uid, u.get('im'), u.get('email'),
+                         u.get('displayName'), json.dumps(attrs)))
+
+    def _write_section(self, uid, n):
+        table = self.SECTIONS[n]
+        self.db.execute('DELETE FROM ' + table + ' WHERE uid = ?', (uid,))
+        lst = self.data['user'][uid].get(n, [])
+        if n == 'alias':
+            lst = sorted(lst.items())
+        for i, x in enumerate(lst):
+            if n == 'alias':
+                row = (uid, i, x[0], x[1])
+            elif n == 'watch':
+                row = (uid, i, x['stream'], x['regex'], json.dumps(x))
+            elif n == 'announce':
+                row = (uid, i, x['stream'], json.dumps(x))
+            else:
+                row = (uid, i, x['stream'], ooo_till(x), json.dumps(x))
+            self.db.execute('INSERT INTO ' + table + ' (' +
+                            self.COLUMNS[n] + ') VALUES (' +
+                            ','.join(['?'] * len(row)) + ')', row)
+
+    def _write_user(self, uid):
+        if not uid in self.data['user']:
+            for table in ['users'] + self.SECTIONS.values():
+                self.db.execute('DELETE FROM ' + table + ' WHERE uid = ?',
+                                (uid,))
+            return
+        self._write_user_row(uid)
+        for n in self.SECTIONS:
+            self._write_section(uid, n)
+
+    def _write_users(self):
+        for table in ['users'] + self.SECTIONS.values():
+            self.db.execute('DELETE FROM ' + table)
+        for uid in self.data.get('user', {}):
+            self._write_user(uid)
+
+    def size(self):
+        return os.path.getsize(self.dbFN)
+
+    def sync(self):
+        t0 = _time.time()
+        if self.dirty:
+            self._snapshot()
+            kind = 'snapshot'
+        elif self.pending:
+            self.db.commit()
+            kind = 'commit'
+        else:
+            return
+        self.pending = []
+        self.pendingSince = None
+        metrics.observe('sidekick_store_sync_seconds', _time.time() - t0,
+                        kind=kind)
+
+    def _snapshot(self):
+        # rewrite all tables, in a single transaction
+        self.db.execute('DELETE FROM meta')
+        for key in self.data:
+            if not key in ['user', 'config', 'rooms']:
+                self._write_meta(key)
+        self._write_config()
+        self._write_users()
+        self.db.commit()
+        self.saved = True
+        self.dirty = False
+
+    def ooo_entries(self, uid, sid):
+        if not uid in self.data['user']:
+            return []
+        olist = self.data['user'][uid]['ooo']
+        return [ (pos, olist[pos]) for (pos,) in self.db.execute(
+                   'SELECT pos FROM ooo WHERE uid = ? AND stream IN (?, ?) '
+                   'ORDER BY pos', (uid, sid, '*')) ]
+
+def migrate_to_sqlite():
+    src = SidekickStore()
+    src.load()
+    dst = SidekickSQLiteStore()
+    if os.path.exists(dst.dbFN):
+        print ">> %s already exists, not migrating" % dst.dbFN
+        return 1
+    dst.load()
+    for uid in src.data.get('user', {}):
+        upgrade_user(src.data['user'][uid])
+    dst.data = src.data
+    dst.dirty = True
+    dst.sync()
+    print ">> migrated %d users from %s to %s" % \
+                  (len(dst.data.get('user', {})), src.cacheFN, dst.dbFN)
+    return 0
+
+# ---------------------------------------------------------------------------
+
+def literal_alternatives(regex):
+    '''
+    returns the list of keywords if the regex is a plain keyword or an
+    alternation of plain keywords (like 'AAPL|MSFT|GOOG'), else None
+    '''
+    alts = [[]]
+    i = 0
+    while i < len(regex):
+        c = regex[i]
+        if c == '|':
+            alts.append([])
+        elif c == '\\':
+            i += 1
+            if i == len(regex) or regex[i].isalnum(): # \d, \b etc
+                return None
+            alts[-1].append(regex[i])
+        elif c in '.^$*+?{}[]()':
+            return None
+        else:
+            alts[-1].append(c)
+        i += 1
+    alts = [''.join(a) for a in alts]
+    if '' in alts: # an empty alternative matches everywhere
+        return None
+    return alts
+
+class KeywordAutomaton:
+    '''
+    Aho-Corasick automaton over a set of keywords, each keyword being
+    owned by a set of uids: one pass over a line yields all owners
+    of matching keywords
+    '''
+
+    # for few keywords, str.__contains__ (in C) beats the automaton loop
+    SCAN_LIMIT = 128
+
+    def __init__(self):
+        self.owners = {}        # keyword -> set of uids
+        self.goto = None        # built lazily, see _build()
+
+    def __len__(self):
+        return len(self.owners)
+
+    def add(self, kw, uid):
+        self.owners.setdefault(kw, set()).add(uid)
+        self.goto = None
+
+    def discard(self, kw, uid):
+        o = self.owners.get(kw)
+        if o is None:
+            return
+        o.discard(uid)
+        if len(o) == 0:
+            del self.owners[kw]
+        self.goto = None
+
+    def _build(self):
+        goto = [ {} ]           # state -> { char : state }
+        out = [ [] ]            # state -> keywords ending here
+        for kw in self.owners:
+            s = 0
+            for c in kw:
+                nxt = goto[s].get(c)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[s][c] = nxt
+                    goto.append({})
+                    out.append([])
+                s = nxt
+            out[s].append(kw)
+        # breadth-first: failure links point to shallower states only
+        fail = [0] * len(goto)
+        queue = collections.deque(goto[0].values())
+        while queue:
+            s = queue.popleft()
+            for c, nxt in goto[s].iteritems():
+                queue.append(nxt)
+                f = fail[s]
+                while f and not c in goto[f]:
+                    f = fail[f]
+                f = goto[f].get(c, 0)
+                fail[nxt] = f
+                if out[f]:
+                    out[nxt] = out[nxt] + out[f]
+        self.fail = fail
+        self.out = out
+        self.goto = goto
+
+    def search(self, line):
+        if len(self.owners) < self.SCAN_LIMIT:
+            uids = set()
+            for kw, o in self.owners.iteritems():
+                if kw in line:
+                    uids |= o
+            return uids
+        if self.goto is None:
+            self._build()
+        goto = self.goto
+        fail = self.fail
+        out = self.out
+        hits = set()
+        s = 0
+        for c in line:
+            while s and not c in goto[s]:
+                s = fail[s]
+            s = goto[s].get(c, 0)
+            if out[s]:
+                hits.update(out[s])
+        uids = set()
+        for kw in hits:
+            uids |= self.owners[kw]
+        return uids
+
+class WatchIndex:
+    '''
+    compiled watch regexes, bucketed by stream id ('*' = all rooms),
+    such that a message is only tested against the watches of its room.
+    Watches that are plain keywords (or alternations of keywords) go
+    into one KeywordAutomaton per bucket instead. Entries are owned by
+    (uid, digest) pairs, digest being the watch's digest interval (0 if
+    matches are reported right away).
+    '''
+
+    def __init__(self):
+        self.buckets = {}       # sid -> { (uid,digest) : [ (w, regexp) ] }
+        self.keywords = {}      # sid -> KeywordAutomaton
+        self.streams = {}       # uid -> set of (sid, (uid,digest))
+        self.literals = {}      # uid -> [ (sid, keyword, (uid,digest)) ]
+        self.mirrors = []       # told of each update_user() (ShardPool)
+
+    def rebuild(self, users):
+        self.buckets = {}
+        self.keywords = {}
+        self.streams = {}
+        self.literals = {}
+        for uid in users:
+            self.update_user(uid, users[uid]['watch'])
+
+    def update_user(self, uid, wlist):
+        # drop all entries of this user, then re-add the current ones
+        for m in self.mirrors:
+            m.update_user(uid, wlist)
+        for sid, key in self.streams.pop(uid, ()):
+            bucket = self.buckets[sid]
+            del bucket[key]
+            if len(bucket) == 0:
+                del self.buckets[sid]
+        for sid, kw, key in self.literals.pop(uid, ()):
+            ac = self.keywords.get(sid)
+            if ac is None: # same keyword listed twice
+                continue
+            ac.discard(kw, key)
+            if len(ac) == 0:
+                del self.keywords[sid]
+        for w in wlist:
+            key = (uid, w.get('digest', 0))
+            kws = literal_alternatives(w['regex'])
+            if kws:
+                ac = self.keywords.setdefault(w['stream'], KeywordAutomaton())
+                for kw in kws:
+                    ac.add(kw, key)
+                    self.literals.setdefault(uid, []).append(
+                                                     (w['stream'], kw, key))
+                continue
+            try:
+                regexp = re.compile(w['regex'])
+            except re.error:
+                trace('watch index: bad regex "%s" of %s' % (w['regex'], uid),
+                      'warn', 'watch')
+                continue
+            bucket = self.buckets.setdefault(w['stream'], {})
+            bucket.setdefault(key, []).append((w, regexp))
+            self.streams.setdefault(uid, set()).add((w['stream'], key))
+
+    def match(self, sid, line):
+        # returns the list of (uid, digest) having a matching watch
+        found = []
+        seen = set()
+        for s in [sid, '*']:
+            ac = self.keywords.get(s)
+            if ac:
+                for uid in ac.search(line):
+                    if not uid in seen:
+                        found.append(uid)
+                        seen.add(uid)
+            bucket = self.buckets.get(s)
+            if not bucket:
+                continue
+            for uid, lst in bucket.iteritems():
+                if uid in seen:
+                    continue
+                for w, regexp in lst:
+                    if regexp.search(line):
+                        found.append(uid)
+                        seen.add(uid)
+                        break
+        return found
+
+watchIndex = WatchIndex()
+
+# ---------------------------------------------------------------------------
+
+class Scheduler:
+    '''
+    min-heap of jobs keyed by the UTC epoch of their firing, run from a
+    timer thread (and from tick(), e.g. on datafeed keep-alives)
+    '''
+
+    def __init__(self, lock):
+        self.lock = lock        # held while a job runs
+        self.heap = []          # [ [epoch, seq, fn, args], ... ]
+        self.seq = itertools.count()
+        self.cv = threading.Condition()
+        self.thread = None
+
+    def schedule(self, when, fn, *args):
+        job = [when, next(self.seq), fn, args]
+        with self.cv:
+            heapq.heappush(self.heap, job)
+            if self.heap[0] is job: # new earliest job, re-arm the timer
+                self.cv.notify()
+        return job
+
+    def cancel(self, job):
+        # (lock must be held) dropped lazily when it reaches the top
+        job[2] = None
+
+    def _pop_due(self, now):
+        due = []
+        with self.cv:
+            while len(self.heap) > 0 and self.heap[0][0] <= now:
+                job = heapq.heappop(self.heap)
+                if job[2]:
+                    due.append(job)
+        return due
+
+    def tick(self, now=None):
+        if now is None:
+            now = _time.time()
+        for job in self._pop_due(now):
+            t0 = _time.time()
+            name = None
+            try:
+                with self.lock:
+                    fn = job[2]
+                    if fn is None: # cancelled while waiting for the lock
+                        continue
+                    name = fn.__name__
+                    fn(*job[3])
+            except Exception, details:
+                s = "Error in scheduled %s: %s" % (name, str(details))
+                trace(s, 'error')
+                print s
+            metrics.observe('sidekick_job_seconds', _time.time() - t0,
+                            job=name)
+
+    def _run(self):
+        while True:
+            with self.cv:
+                now = _time.time()
+                while len(self.heap) == 0 or self.heap[0][0] > now:
+                    if len(self.heap) == 0:
+                        self.cv.wait()
+                    else:
+                        self.cv.wait(self.heap[0][0] - now)
+                    now = _time.time()
+            try:
+                self.tick(now)
+            except Exception, details: # keep the timer alive
+                s = "Error in scheduler: " + str(details)
+                trace(s, 'error')
+                print s
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='scheduler')
+        self.thread.daemon = True
+        self.thread.start()
+
+# ---------------------------------------------------------------------------
+
+class TokenBucket:
+
+    def __init__(self, rate, burst):
+        self.rate = rate        # tokens per second
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = _time.time()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        # takes a token, returns the seconds to wait until it is valid
+        with self.lock:
+            now = _time.time()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+class OutboundQueue:
+    '''
+    outbound messages, sent asynchronously: a bounded queue drained by
+    worker threads, in order per stream and in parallel across streams,
+    under a global and a per-stream rate limit. Text messages to the
+    same stream within the coalesce window are merged into one, and
+    transient failures are retried with exponential backoff.
+    '''
+
+    MAX_MERGED = 4000           # chars of a coalesced text message
+
+    def __init__(self, bridge, workers=4, maxsize=1000, rate=20.0,
+                 stream_rate=2.0, burst=5, coalesce=0.2, retries=4,
+                 backoff=0.5):
+        self.bridge = bridge
+        self.nworkers = workers
+        self.maxsize = maxsize
+        self.rate = TokenBucket(rate, burst * workers)
+        self.stream_rate = stream_rate
+        self.burst = burst
+        self.buckets = {}       # sid -> TokenBucket
+        self.coalesce = coalesce
+        self.retries = retries
+        self.backoff = backoff
+        self.cv = threading.Condition()
+        self.pending = {}       # sid -> deque of items
+        self.ready = collections.deque() # sids with items, not in work
+        self.busy = set()       # sids a worker is sending to
+        self.size = 0
+        self.threads = []
+
+    def put(self, sid, msgFormat, message, attachments=None, alt=None,
+            callback=None):
+        # blocks while the queue is full (backpressure to the producer)
+        item = { 'sid': sid, 'format': msgFormat, 'msg': message,
+                 'attachments': attachments, 'alt': alt,
+                 'callback': callback, 't': _time.time() }
+        with self.cv:
+            while self.size >= self.maxsize:
+                self.cv.wait()
+            if not sid in self.pending:
+                self.pending[sid] = collections.deque()
+                if not sid in self.busy:
+                    self.ready.append(sid)
+            self.pending[sid].append(item)
+            self.size += 1
+            self.cv.notify_all()
+
+    def qsize(self):
+        return self.size
+
+    def drain(self):
+        # waits until all queued messages went out
+        with self.cv:
+            while self.size > 0 or len(self.busy) > 0:
+                self.cv.wait(1.0)
+
+    def close(self, timeout=10.0):
+        # at exit (the workers are daemons): sends what is queued, without
+        # waiting to coalesce, for at most timeout seconds
+        deadline = _time.time() + timeout
+        with self.cv:
+            self.coalesce = 0
+            self.cv.notify_all()
+            while (self.size > 0 or len(self.busy) > 0) and self.threads:
+                left = deadline - _time.time()
+                if left <= 0:
+                    break
+                self.cv.wait(left)
+            if self.size > 0 or len(self.busy) > 0:
+                s = "Exiting with %d outbound messages unsent, %d in " \
+                    "flight" % (self.size, len(self.busy))
+                trace(s, 'error')
+                print s
+
+    def _mergeable(self, item):
+        return item['format'] == 'TEXT' and not item['attachments']
+
+    def _take(self):
+        # waits for a stream whose head item may go out now, and returns
+        # that stream's items to be sent as one message
+        with self.cv:
+            while True:
+                now = _time.time()
+                wait = None
+                for sid in self.ready:
+                    head = self.pending[sid][0]
+                    due = head['t']
+                    if self._mergeable(head):
+                        due += self.coalesce
+                    if due <= now:
+                        break
+                    if wait is None or due - now < wait:
+                        wait = due - now
+                else:
+                    self.cv.wait(wait)
+                    continue
+                self.ready.remove(sid)
+                self.busy.add(sid)
+                q = self.pending[sid]
+                items = [ q.popleft() ]
+                if self._mergeable(items[0]):
+                    n = len(items[0]['msg'])
+                    while len(q) > 0 and self._mergeable(q[0]) and \
+                          q[0]['t'] <= items[0]['t'] + self.coalesce and \
+                          n + len(q[0]['msg']) < self.MAX_MERGED:
+                        n += len(q[0]['msg']) + 1
+                        items.append(q.popleft())
+                self.size -= len(items)
+                self.cv.notify_all()
+                return sid, items
+
+    def _done(self, sid):
+        with self.cv:
+            self.busy.discard(sid)
+            if len(self.pending[sid]) > 0:
+                self.ready.append(sid)
+            else:
+                del self.pending[sid]
+            self.cv.notify_all()
+
+    def _send(self, sid, msgFormat, message, attachments):
+        # returns None on success, else the (last) exception
+        n = 0
+        while True:
+            if not sid in self.buckets:
+                self.buckets[sid] = TokenBucket(self.stream_rate, self.burst)
+            _time.sleep(max(self.buckets[sid].reserve(),
+                            self.rate.reserve()))
+            try:
+                self.bridge.send_message(sid, msgFormat, message, attachments)
+                return None
+            except Exception, details:
+                transient = isinstance(details, (requests.ConnectionError,
+                                                 requests.Timeout)) or \
+                            (isinstance(details, RESTError) and \
+                             details.is_transient())
+                if not transient or n == self.retries:
+                    return details
+            _time.sleep(self.backoff * (2 ** n) * (0.5 + random.random()))
+            n += 1
+
+    def _work(self):
+        while True:
+            sid, items = self._take()
+            try:
+                head = items[0]
+                if len(items) == 1:
+                    msg = head['msg']
+                else:
+                    msg = '\n'.join([i['msg'] for i in items])
+                metrics.observe('sidekick_outbound_wait_seconds',
+                                _time.time() - head['t'])
+                err = self._send(sid, head['format'], msg, head['attachments'])
+                if err and head['alt'] is not None:
+                    err = self._send(sid, 'TEXT', head['alt'],
+                                     head['attachments'])
+                metrics.inc('sidekick_outbound_messages_total',
+                            result='failed' if err else 'sent')
+                if err:
+                    s = "Error sending to %s: %s" % (sid, str(err))
+                    trace(s, 'error')
+                    print s
+                for i in items:
+                    if i['callback']:
+                        i['callback'](sid, err)
+            except Exception, details:
+                trace("Error in outbound worker: %s" % str(details), 'error')
+            self._done(sid)
+
+    def start(self):
+        for i in range(self.nworkers):
+            t = threading.Thread(target=self._work, name='outbound-%d' % i)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+class FanOut:
+    '''
+    one text message to many streams through an OutboundQueue, with at
+    most 'limit' of them queued or in flight at any time. Runs on its
+    own thread, which also calls check(sid), if given: streams it says
+    False for are left out. report(results, skipped) is called once all
+    streams are done, results mapping each streamId to None (sent) or
+    the error, skipped listing the streams left out.
+    '''
+
+    def __init__(self, queue, sids, msg, limit=16, report=None, check=None):
+        self.queue = queue
+        self.sids = sids
+        self.msg = msg
+        self.report = report
+        self.check = check
+        self.slots = threading.Semaphore(limit)
+        self.results = {}
+        self.skipped = []
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+    def _finished(self):
+        # (self.lock must be held)
+        if len(self.results) + len(self.skipped) == len(self.sids):
+            self.done.set()
+
+    def _sent(self, sid, err):
+        self.slots.release()
+        with self.lock:
+            self.results[sid] = err
+            self._finished()
+
+    def _run(self):
+        for sid in self.sids:
+            if self.check and not self.check(sid):
+                with self.lock:
+                    self.skipped.append(sid)
+                    self._finished()
+                continue
+            self.slots.acquire()
+            self.queue.put(sid, 'TEXT', self.msg, callback=self._sent)
+        self.done.wait()
+        if self.report:
+            try:
+                self.report(self.results, self.skipped)
+            except Exception, details:
+                trace("Error in fan-out report: %s" % str(details), 'error')
+
+    def start(self):
+        if len(self.sids) == 0:
+            self.done.set()
+        t = threading.Thread(target=self._run, name='fanout')
+        t.daemon = True
+        t.start()
+        return t
+
+# ---------------------------------------------------------------------------
+
+class UserDirectory:
+    '''
+    cache of user attributes (displayName, emailAddress) with a TTL and
+    an LRU size limit. Users we may not look up are cached as None, for
+    a shorter time. prefetch() resolves a batch of uids ahead of use,
+    with one bulk call per BULK uids instead of one call per uid.
+    '''
+
+    BULK = 100
+    HIT  = metrics.key('sidekick_cache_lookups_total', cache='users',
+                       result='hit')
+    MISS = metrics.key('sidekick_cache_lookups_total', cache='users',
+                       result='miss')
+
+    def __init__(self, bridge, ttl=3600, neg_ttl=300, maxsize=10000):
+        self.bridge = bridge
+        self.ttl = ttl
+        self.neg_ttl = neg_ttl
+        self.maxsize = maxsize
+        self.cache = collections.OrderedDict() # uid -> (expires, attrs)
+        self.lock = threading.Lock()
+        self.bulk = True        # False once pod/v3/users was refused
+
+    def _get(self, uid):
+        with self.lock:
+            ent = self.cache.get(uid)
+            if ent is not None and ent[0] < _time.time():
+                del self.cache[uid]
+                ent = None
+            if ent is None:
+                metrics.add(self.MISS)
+                return False, None
+            del self.cache[uid] # move to the end: most recently used
+            self.cache[uid] = ent
+        metrics.add(self.HIT)
+        return True, ent[1]
+
+    def _put(self, uid, attrs):
+        ttl = self.ttl if attrs is not None else self.neg_ttl
+        with self.lock:
+            self.cache.pop(uid, None)
+            self.cache[uid] = (_time.time() + ttl, attrs)
+            while len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+
+    def lookup(self, uid):
+        # the user's attributes, or None if not visible to us
+        hit, attrs = self._get(uid)
+        if not hit:
+            attrs = self.bridge.get_user_info(uid)
+            self._put(uid, attrs)
+        return attrs
+
+    def prefetch(self, uids):
+        todo = [ uid for uid in set(uids) if not self._get(uid)[0] ]
+        while len(todo) > 0 and self.bulk:
+            chunk, todo = todo[:self.BULK], todo[self.BULK:]
+            try:
+                users = self.bridge.get_users(chunk)
+            except RESTError, details:
+                if details.is_transient():
+                    return
+                self.bulk = False # not entitled: fall back to single calls
+                todo += chunk
+                break
+            for uid in users:
+                self._put(uid, users[uid])
+        for uid in todo:
+            self.lookup(uid)
+
+    def email(self, uid):
+        attrs = self.lookup(uid)
+        return attrs.get('emailAddress') if attrs else None
+
+    def name(self, uid):
+        attrs = self.lookup(uid)
+        return attrs.get('displayName') if attrs else None
+
+mentionUID = re.compile('<mention[^>]*\\buid="(\\d+)"')
+
+def event_uids(events):
+    # uids of senders and mentioned users, to prefetch for a batch
+    uids = []
+    for e in events:
+        if not e or not 'message' in e:
+            continue
+        uids.append(str(e['fromUserId']))
+        uids += mentionUID.findall(e['message'])
+    return uids
+
+class RoomRegistry:
+    '''
+    room metadata (name, members, lastSeen), persisted in the store
+    under 'rooms'. Stale entries are served while a background thread
+    refreshes them; concurrent lookups of the same room share a single
+    pod request. Fetched entries are written to the store by flush(),
+    from the thread holding the store lock. Whether a stream is an IM
+    is up to is_IM(): IMs are never looked up here.
+    '''
+
+    TTL        = 24 * 3600      # refresh entries older than this
+    SEEN_GRAIN = 600            # persist lastSeen at most this often
+    DORMANT    = 30 * 24 * 3600 # rooms silent for this long are dormant
+    WAIT       = 10.0           # max. seconds to wait for a first fetch
+    HIT   = metrics.key('sidekick_cache_lookups_total', cache='rooms',
+                        result='hit')
+    MISS  = metrics.key('sidekick_cache_lookups_total', cache='rooms',
+                        result='miss')
+    STALE = metrics.key('sidekick_cache_lookups_total', cache='rooms',
+                        result='stale')
+
+    def __init__(self, bridge, store):
+        self.bridge = bridge
+        self.store = store
+        self.rooms = dict(store.data.get('rooms', {})) # sid -> entry
+        self.updates = {}       # sid -> entry, not yet in the store
+        self.inflight = {}      # sid -> Event, set when the fetch is done
+        self.lock = threading.Lock()
+
+    def get(self, sid):
+        # the room's entry, or None if we do not know the room (yet)
+        with self.lock:
+            ent = self.rooms.get(sid)
+        if ent is None or ent['fetched'] == 0: # never fetched
+            metrics.add(self.MISS)
+            ent = self._fetch(sid)
+        elif ent['fetched'] + self.TTL < _time.time():
+            metrics.add(self.STALE)
+            self.refresh(sid)
+        else:
+            metrics.add(self.HIT)
+        self.flush()
+        return ent
+
+    def name(self, sid):
+        # (store lock must be held, for is_IM)
+        if is_IM(sid):
+            return "[sid=%s]" % sid
+        ent = self.get(sid)
+        if ent is None or ent['name'] is None:
+            return "[sid=%s]" % sid
+        return ent['name']
+
+    def seen(self, sid):
+        now = _time.time()
+        with self.lock:
+            ent = self.rooms.get(sid)
+            if ent is None: # first activity: fetch the details on use
+                ent = { 'name' : None, 'members' : None,
+                        'lastSeen' : now, 'fetched' : 0 }
+            elif now - ent['lastSeen'] < self.SEEN_GRAIN:
+                return
+            else:
+                ent = dict(ent, lastSeen=now)
+            self.rooms[sid] = ent
+            self.updates[sid] = ent
+
+    def dormant(self, sid):
+        # True if the room has been silent for DORMANT (unknown: False)
+        with self.lock:
+            ent = self.rooms.get(sid)
+        return ent is not None and \
+               ent['lastSeen'] < _time.time() - self.DORMANT
+
+    def refresh(self, sid):
+        with self.lock:
+            if sid in self.inflight:
+                return
+        t = threading.Thread(target=self._fetch, args=(sid,),
+                             name='room-' + sid)
+        t.daemon = True
+        t.start()
+
+    def _fetch(self, sid):
+        with self.lock:
+            ev = self.inflight.get(sid)
+            owner = ev is None
+            if owner:
+                ev = self.inflight[sid] = threading.Event()
+        if not owner: # somebody else is asking already
+            ev.wait(self.WAIT)
+            with self.lock:
+                return self.rooms.get(sid)
+        try:
+            ent = self._query(sid)
+        except Exception, details:
+            trace("room info for %s: %s" % (sid, str(details)), 'warn', 'room')
+            ent = None
+        with self.lock:
+            if ent:
+                old = self.rooms.get(sid)
+                if old:
+                    ent['lastSeen'] = old['lastSeen']
+                self.rooms[sid] = ent
+                self.updates[sid] = ent
+            del self.inflight[sid]
+            ent = self.rooms.get(sid)
+        ev.set()
+        return ent
+
+    def _query(self, sid):
+        now = _time.time()
+        ent = { 'name' : None, 'members' : None,
+                'lastSeen' : now, 'fetched' : now }
+        room = self.bridge.get_room_info(sid)
+        if room is None: # not visible to us: remember that, too
+            return ent
+        ent['name'] = room['roomAttributes']['name']
+        members = self.bridge.get_room_members(sid)
+        if members is not None:
+            ent['members'] = len(members)
+        return ent
+
+    def flush(self):
+        # write fetched entries to the store (store lock must be held)
+        with self.lock:
+            updates, self.updates = self.updates, {}
+        for sid in updates:
+            self.store.setVal(['rooms', sid], updates[sid])
 
 # ---------------------------------------------------------------------------
 # convenience:
@@ -226,53 +1789,258 @@ class SidekickStore:
 def send_with_mention(sid, uid, msg, attachments=None):
     try:
         email = get_cached_user_email(uid)
-        msg = "<mention email=\"%s\"/> %s" % (email, msg)
-        msg = '<messageML>' + msg + '</messageML>'
-        sym.send_message(sid, 'MESSAGEML', msg, attachments)
     except:
-        sym.send_message(sid, 'TEXT', msg, attachments)
+        email = None
+    if not email:
+        outq.put(sid, 'TEXT', msg, attachments)
+        return
+    mml = "<mention email=\"%s\"/> %s" % (email, msg)
+    mml = '<messageML>' + mml + '</messageML>'
+    outq.put(sid, 'MESSAGEML', mml, attachments, alt=msg)
 
 def send_txt_message(sid, msg):
-        sym.send_message(sid, 'TEXT', msg)
+    outq.put(sid, 'TEXT', msg)
 
 def get_cached_user_IM(uid):
     if 'im' in SKS.data['user'][uid]:
         return SKS.data['user'][uid]['im']
     im = sym.get_user_IM(uid)
-    SKS.data['user'][uid]['im'] = im
-    SKS.dirty = True
+    SKS.setVal(['user', uid, 'im'], im)
+    SKS.ims[im] = uid
     return im
 
 def get_cached_user_email(uid):
-    if 'email' in SKS.data['user'][uid]:
-        return SKS.data['user'][uid]['email']
-    # once we are entitled to get this info, we should cache it here
-    return sym.get_user_email(uid)
+    u = SKS.data['user'].get(uid, {})
+    if 'email' in u:
+        return u['email']
+    return userdir.email(uid)
 
 def get_cached_user_name(uid):
-    if 'displayName' in SKS.data['user'][uid]:
-        return SKS.data['user'][uid]['displayName']
-    # once we are entitled to get this info, we should cache it here
-    return sym.get_user_name(uid)
-
-tracef = None
-
-def trace(s):
-    global tracef
-    if not tracef:
-        fn = os.environ['HOME'] + '/.symphony'
-        if not os.path.exists(fn):
-            os.makedirs(fn)
-            os.chmod(SKS.cacheFN, 0o700)
-        fn += '/sidekick-' + datetime.today().strftime('%Y%m%d-%H%M%S') + '.log'
-        tracef = open(fn, 'w')
-    tracef.write(datetime.today().strftime('%Y%m%d-%H%M%S') + ': ' + s + '\n')
-    tracef.flush()
+    u = SKS.data['user'].get(uid, {})
+    if 'displayName' in u:
+        return u['displayName']
+    name = userdir.name(uid)
+    if name is None:
+        return "[uid=%s]" % uid
+    return name
+
+class TraceLog:
+    '''
+    the trace log, ~/.symphony/<name>.log: log() only appends a
+    record to an in-memory ring buffer (dropping the oldest when full),
+    a background thread writes the records as JSON lines, with one
+    flush per batch. The log is rotated at start, when it gets too big
+    or too old; rotated logs are gzipped and the newest KEEP are kept.
+    The level and the per-category sample rates can be changed at any
+    time.
+    '''
+
+    LEVELS    = { 'debug' : 10, 'info' : 20, 'warn' : 30, 'error' : 40 }
+    BUFFER    = 10000           # records held for the writer
+    INTERVAL  = 0.25            # seconds between writes (errors: at once)
+    MAX_BYTES = 64 << 20        # rotate when bigger,
+    MAX_AGE   = 24 * 3600       # or older than this
+    KEEP      = 20              # rotated logs to keep
+
+    def __init__(self, name='sidekick'):
+        self.name = name
+        self.level = self.LEVELS['info']
+        self.sample = { 'event' : 0.01 } # category -> fraction logged
+        self.buf = collections.deque(maxlen=self.BUFFER)
+        self.dropped = 0
+        self.wake = threading.Event()
+        self.lock = threading.Lock()  # held while writing
+        self.thread = None
+        self.stopped = False
+        self.f = None
+        self.fn = None
+        self.opened = None      # when the current log was started
+        self.size = 0
+
+    def set_level(self, name):
+        self.level = self.LEVELS[name]
+
+    def level_name(self):
+        return [n for n in self.LEVELS if self.LEVELS[n] == self.level][0]
+
+    def log(self, level, cat, msg):
+        if self.LEVELS[level] < self.level:
+            return
+        rate = self.sample.get(cat)
+        if rate is not None and random.random() >= rate:
+            return
+        if len(self.buf) == self.BUFFER:
+            self.dropped += 1
+        self.buf.append((_time.time(), level, cat, msg))
+        if self.thread is None:
+            self._start()
+        if level == 'error':
+            self.wake.set()
+
+    def _start(self):
+        with self.lock:
+            if self.thread:
+                return
+            self.thread = threading.Thread(target=self._run, name='trace')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _run(self):
+        while not self.stopped:
+            self.wake.wait(self.INTERVAL)
+            self.wake.clear()
+            try:
+                self.flush()
+            except Exception, details:
+                print "Error in trace log: " + str(details)
+
+    def _format(self, rec):
+        t, level, cat, msg = rec
+        stamp = _time.strftime('%Y-%m-%dT%H:%M:%S', _time.localtime(t)) + \
+                '.%03d' % (t % 1 * 1000)
+        d = { 't' : stamp, 'level' : level, 'cat' : cat, 'msg' : msg }
+        try:
+            return json.dumps(d)
+        except (TypeError, ValueError): # not JSON, or not UTF-8
+            if isinstance(msg, str):
+                d['msg'] = msg.decode('utf-8', 'replace')
+            else:
+                d['msg'] = repr(msg)
+            return json.dumps(d)
+
+    def flush(self):
+        with self.lock:
+            if len(self.buf) == 0 and self.dropped == 0:
+                return
+            if self.f is None:
+                self._open()
+            lines = []
+            if self.dropped > 0:
+                lines.append(self._format((_time.time(), 'warn', 'trace',
+                             "%d records dropped" % self.dropped)))
+                self.dropped = 0
+            while len(self.buf) > 0:
+                lines.append(self._format(self.buf.popleft()))
+            data = '\n'.join(lines) + '\n'
+            self.f.write(data)
+            self.f.flush()
+            self.size += len(data)
+            if self.size > self.MAX_BYTES or \
+               _time.time() - self.opened > self.MAX_AGE:
+                self._rotate()
+
+    def _open(self):
+        d = os.environ['HOME'] + '/.symphony'
+        if not os.path.exists(d):
+            os.makedirs(d)
+            os.chmod(d, 0o700)
+        self.fn = d + '/' + self.name + '.log'
+        if os.path.exists(self.fn) and os.path.getsize(self.fn) > 0:
+            self._archive(os.path.getmtime(self.fn)) # the previous run's
+        self.f = open(self.fn, 'a')
+        os.chmod(self.fn, 0o600)
+        self.opened = _time.time()
+        self.size = 0
+
+    def _rotate(self):
+        self.f.close()
+        self._archive(_time.time())
+        self.f = open(self.fn, 'a')
+        os.chmod(self.fn, 0o600)
+        self.opened = _time.time()
+        self.size = 0
+
+    def _archive(self, t):
+        # gzip the log to <name>-<t>[-N].log.gz (t: its end), prune old
+        # ones: oldest first by time, then by the N of the same second
+        d = os.path.dirname(self.fn)
+        stamp = _time.strftime('%Y%m%d-%H%M%S', _time.localtime(t))
+        mine = re.compile(re.escape(self.name) +
+                          '-([0-9]{8}-[0-9]{6})(?:-([0-9]+))?\\.log\\.gz$')
+        old = []
+        for fn in os.listdir(d):
+            m = mine.match(fn)
+            if m:
+                old.append((m.group(1), int(m.group(2) or 0), fn))
+        # after the ones of the same second, even if those got pruned
+        n = max([k + 1 for (s, k, fn) in old if s == stamp] or [0])
+        fn = self.name + '-' + stamp + ('-%d' % n if n else '') + '.log.gz'
+        with open(self.fn, 'rb') as fi:
+            fo = gzip.open(d + '/' + fn, 'wb')
+            shutil.copyfileobj(fi, fo)
+            fo.close()
+        os.chmod(d + '/' + fn, 0o600)
+        os.unlink(self.fn)
+        old.append((stamp, n, fn))
+        old.sort()
+        for s, k, fn in old[:-self.KEEP]:
+            os.unlink(d + '/' + fn)
+
+    def close(self):
+        # write what is buffered, and close the file (reopened on use)
+        self.flush()
+        with self.lock:
+            if self.f:
+                self.f.close()
+                self.f = None
+
+    def shutdown(self):
+        # at exit: stop the writer before the interpreter goes, then close
+        self.stopped = True
+        self.wake.set()
+        if self.thread:
+            self.thread.join(1)
+        self.close()
+
+tracelog = TraceLog()
+atexit.register(tracelog.shutdown)
+
+def trace(s, level='info', cat='trace'):
+    tracelog.log(level, cat, s)
+
+streamHit  = metrics.key('sidekick_cache_lookups_total', cache='streams',
+                         result='hit')
+streamMiss = metrics.key('sidekick_cache_lookups_total', cache='streams',
+                         result='miss')
 
 def is_IM(sid):
-    s = [ SKS.data['user'][uid]['im'] for uid in SKS.data['user'] \
-                                           if 'im' in SKS.data['user'][uid] ]
-    return sid in s
+    if sid in SKS.ims:
+        metrics.add(streamHit)
+        return True
+    if not 'streamTypes' in SKS.data['config']:
+        SKS.setVal(['config', 'streamTypes'], {})
+    if sid in SKS.data['config']['streamTypes']:
+        metrics.add(streamHit)
+        return False
+    metrics.add(streamMiss)
+    # first time we see this stream
+    return learn_IM(sid)
+
+def learn_IM(sid):
+    # asks the pod about the stream and remembers the answer; the store
+    # lock is only taken for the latter (so callers need not hold it)
+    try:
+        info = sym.get_stream_info(sid)
+    except Exception, details:
+        trace("is_IM(%s): %s" % (sid, str(details)), 'warn', 'room')
+        return False
+    t = 'UNKNOWN'
+    if info and 'streamType' in info:
+        t = info['streamType']['type']
+    with SKS.lock:
+        if not 'streamTypes' in SKS.data['config']:
+            SKS.setVal(['config', 'streamTypes'], {})
+        SKS.setVal(['config', 'streamTypes', sid], t)
+        if not t in IM_STREAM_TYPES:
+            return False
+        uid = None
+        if t == 'IM' and 'streamAttributes' in info:
+            others = [str(m) for m in info['streamAttributes']['members']
+                                                     if not str(m) == my_id]
+            if len(others) == 1:
+                uid = others[0]
+        SKS.ims[sid] = uid
+    return True
 
 def parse_time(d, t, z):
     try:
@@ -298,25 +2066,66 @@ def parse_time(d, t, z):
 def render_time(dt):
     return dt.strftime('%x %H:%M ') + dt.tzinfo.zone
 
+def to_epoch(dt):
+    return calendar.timegm(dt.utctimetuple())
+
+def parse_interval(s):
+    # '90s', '15m', '2h', '1d' -> seconds, None if not an interval
+    m = re.match('^([0-9]+)([smhd])$', s)
+    if not m:
+        return None
+    return int(m.group(1)) * {'s': 1, 'm': 60, 'h': 3600, 'd': 86400} \
+                                                              [m.group(2)]
+
+def render_interval(secs):
+    for unit, n in [('d', 86400), ('h', 3600), ('m', 60)]:
+        if secs % n == 0:
+            return "%d%s" % (secs / n, unit)
+    return "%ds" % secs
+
+def ooo_till(o):
+    # an ooo entry expires when its 'till' day begins (local time)
+    try:
+        return _time.mktime(datetime.strptime(o['till'], '%x').timetuple())
+    except ValueError:
+        return None
+
+def next_repeat(dt, repeat):
+    # same wall-clock time one period later, in the announcement's zone
+    t = dt.replace(tzinfo=None)
+    if repeat == 'daily':
+        t += timedelta(days=1)
+    elif repeat == 'weekly':
+        t += timedelta(days=7)
+    elif repeat == 'monthly':
+        y, m = divmod(t.month, 12)
+        y += t.year
+        m += 1
+        t = t.replace(year=y, month=m,
+                      day=min(t.day, calendar.monthrange(y, m)[1]))
+    else:
+        return None
+    return pytz.timezone(dt.tzinfo.zone).localize(t)
+
 # ---------------------------------------------------------------------------
 
-def not_implemented(e, line, args):
-    send_txt_message(e['streamId'], "'%s' is not implemented yet" % args[1])
+def not_implemented(ctx, line, args):
+    send_txt_message(ctx.sid, "'%s' is not implemented yet" % args[1])
 
-def do_cmd_list(e, line, args):
-    send_txt_message(e['streamId'], help_text['cmd_list'])
+def do_cmd_list(ctx, line, args):
+    send_txt_message(ctx.sid, help_text['cmd_list'])
 
-def do_examples(e, line, args):
-    send_txt_message(e['streamId'], help_text['examples'])
+def do_examples(ctx, line, args):
+    send_txt_message(ctx.sid, help_text['examples'])
 
-def do_help(e, line, args):
-    send_txt_message(e['streamId'], help_text['help'])
+def do_help(ctx, line, args):
+    send_txt_message(ctx.sid, help_text['help'])
 
-def do_intro(e, line, args):
-    send_txt_message(e['streamId'], help_text['intro'])
+def do_intro(ctx, line, args):
+    send_txt_message(ctx.sid, help_text['intro'])
 
 def do_status_alias(sid, uid):
-    lst = [a for a in SKS.data['user'][uid]['alias']]
+    lst = sorted(SKS.data['user'][uid]['alias'].items())
     if len(lst) == 0:
         send_txt_message(sid, "Aliases: (none)")
         return
@@ -338,7 +2147,7 @@ def do_status_announce(sid, uid):
         elif a['stream'] == sid:
             rn = "this room"
         else:
-            rn = sym.get_room_name(a['stream'])
+            rn = rooms.name(a['stream'])
         if a['repeat'] == 'daily':
             rpt = ' -daily'
         elif a['repeat'] == 'weekly':
@@ -364,7 +2173,7 @@ def do_status_ooo(sid, uid):
         elif o['stream'] == sid:
             rn = "this room"
         else:
-            rn = sym.get_room_name(o['stream'])
+            rn = rooms.name(o['stream'])
         s += "%d)  ooo %s %s (--> %s)\n" % (n, o['till'], o['msg'], rn)
         n += 1
     send_txt_message(sid, s)
@@ -382,14 +2191,16 @@ def do_status_watch(sid, uid):
         elif w['stream'] == sid:
             rn = "this room"
         else:
-            rn = sym.get_room_name(w['stream'])
+            rn = rooms.name(w['stream'])
+        if 'digest' in w:
+            rn += ", digest every %s" % render_interval(w['digest'])
         s += "%d)  watch for '%s' (<-- %s)\n" % (n, w['regex'], rn)
         n += 1
     send_txt_message(sid, s)
     
-def do_status(e, line, args):
-    uid = str(e['fromUserId'])
-    send_with_mention(e['streamId'], uid,
+def do_status(ctx, line, args):
+    uid = ctx.uid
+    send_with_mention(ctx.sid, uid,
            "A status report will be sent to your Sidekick chat room shortly.")
 
     sid = get_cached_user_IM(uid)
@@ -399,50 +2210,47 @@ def do_status(e, line, args):
     do_status_ooo(sid, uid)
     do_status_watch(sid, uid)
 
-def do_alias(e, line, args):
-    uid = str(e['fromUserId'])
+def do_alias(ctx, line, args):
+    uid = ctx.uid
     if len(args) < 3:
-        do_status_alias(e['streamId'], uid)
+        do_status_alias(ctx.sid, uid)
         return
     line = line[line.index(args[2]):].split('=', 1)
+    aliases = SKS.data['user'][uid]['alias']
     if len(line) == 1: # display existing alias bindings
-        for a in SKS.data['user'][uid]['alias']:
-            if a[0] == line[0]:
-                send_txt_message(e['streamId'], "alias %s=%s" % (a[0], a[1]))
-                return
-        send_txt_message(e['streamId'], "No such alias %s" % line[0])
+        if line[0] in aliases:
+            send_txt_message(ctx.sid,
+                             "alias %s=%s" % (line[0], aliases[line[0]]))
+        else:
+            send_txt_message(ctx.sid, "No such alias %s" % line[0])
         return
     if line[-1] == '': # undefine existing alias
-        for a in SKS.data['user'][uid]['alias']:
-            if a[0] == line[0]:
-                SKS.data['user'][uid]['alias'].remove(a)
-                SKS.dirty = True
-                send_txt_message(e['streamId'], "Removing alias for %s" % a[0])
-                return
-        send_txt_message(e['streamId'], "No such alias %s" % line[0])
+        if line[0] in aliases:
+            SKS.delVal(['user', uid, 'alias', line[0]])
+            drop_alias_trigger(line[0])
+            send_txt_message(ctx.sid, "Removing alias for %s" % line[0])
+        else:
+            send_txt_message(ctx.sid, "No such alias %s" % line[0])
         return
     # print line
-    if line[0] in ['/sidekick', '/sk']:
-        send_txt_message(e['streamId'],
+    if line[0] in TRIGGERS:
+        send_txt_message(ctx.sid,
                          "You can't redefine the default Sidekick triggers.")
         return
-    a = [a for a in SKS.data['user'][uid]['alias'] if a[0] == line[0]]
-    if len(a) == 0:
-        a = [line[0], line[1]]
-        # print "appending alias %s" % str(a)
-        SKS.data['user'][uid]['alias'].append(a)
-        SKS.dirty = True
-        send_txt_message(e['streamId'],
+    if not line[0] in aliases:
+        SKS.setVal(['user', uid, 'alias', line[0]], line[1])
+        aliasTriggers[line[0]] += 1
+        send_txt_message(ctx.sid,
                          "Adding new alias %s=%s" % (line[0], line[1]))
     else:
-        a[1] = line[1]
-        send_txt_message(e['streamId'],
+        SKS.setVal(['user', uid, 'alias', line[0]], line[1])
+        send_txt_message(ctx.sid,
                          "Redefining alias %s=%s" % (line[0], line[1]))
    
-def do_announce(e, line, args):
-    uid = str(e['fromUserId'])
+def do_announce(ctx, line, args):
+    uid = ctx.uid
     if len(args) < 3:
-        send_txt_message(e['streamId'],
+        send_txt_message(ctx.sid,
             "A status report will be sent to your Sidekick chat room shortly.")
         do_status_announce(get_cached_user_IM(uid), uid)
         return
@@ -468,10 +2276,11 @@ def do_announce(e, line, args):
 
     if line[0] == 'cancel':
         if len(line) == 1 or line[1] == '':
-            do_status_announce(e['streamId'], uid)
-            SKS.data['user'][uid]['announce'] = []
-            SKS.dirty = True
-            send_txt_message(e['streamId'],
+            do_status_announce(ctx.sid, uid)
+            for a in SKS.data['user'][uid]['announce']:
+                unschedule_announce(a)
+            SKS.setVal(['user', uid, 'announce'], [])
+            send_txt_message(ctx.sid,
                              "All announce entries above were deleted")
             return
         nr = 0
@@ -486,32 +2295,31 @@ def do_announce(e, line, args):
             nr -= 1
             msg = "announce entry for %s (%s) was removed" % (alist[nr]['when'],
                                                            alist[nr]['msg'])
-            del alist[nr]
-            SKS.dirty = True
-        send_txt_message(e['streamId'], msg)
+            unschedule_announce(alist[nr])
+            SKS.delVal(['user', uid, 'announce', nr])
+        send_txt_message(ctx.sid, msg)
         return
 
-    now = datetime.today()
-    now = pytz.timezone(__SERVER_TIMEZONE__).localize(now)
+    now = datetime.now(pytz.timezone(__SERVER_TIMEZONE__))
     if line[0] == 'now':
         dts = render_time(now)
         del line[0]
     elif len(line) > 2:
         dt = parse_time(line[0], line[1], line[2])
         if dt == None:
-            send_txt_message(e['streamId'], "Cannot parse \"%s %s %s\"" % \
+            send_txt_message(ctx.sid, "Cannot parse \"%s %s %s\"" % \
                                                    (line[0], line[1], line[2]))
             return
         dts = render_time(dt)
         if dt < now:
-            send_txt_message(e['streamId'],
+            send_txt_message(ctx.sid,
                              "announce command: '%s' is in the past" % dts)
             return
         del line[0]
         del line[0]
         del line[0]
     else:
-        send_txt_message(e['streamId'],
+        send_txt_message(ctx.sid,
                          "announce command: not enough arguments")
         return
 
@@ -520,24 +2328,24 @@ def do_announce(e, line, args):
     if allRooms:
         sid = '*'
     else:
-        sid = e['streamId']
+        sid = ctx.sid
     a['stream'] = sid
-    SKS.data['user'][uid]['announce'].append(a)
-    SKS.dirty = True
+    SKS.appendVal(['user', uid, 'announce'], a)
+    schedule_announce(uid, a)
 
     if sid == '*':
         sid = "in all rooms"
     else:
         sid = "in this room only"
-    send_with_mention(e['streamId'], uid,
+    send_with_mention(ctx.sid, uid,
                       "A new announce task is active for %s: %s (%s)" % \
                                                    (a['when'], a['msg'], sid))
 
-def do_ooo(e, line, args):
-    uid = str(e['fromUserId'])
-    trace("do_ooo " + uid)
+def do_ooo(ctx, line, args):
+    uid = ctx.uid
+    trace("do_ooo " + uid, cat='ooo')
     if len(args) < 3:
-        send_txt_message(e['streamId'],
+        send_txt_message(ctx.sid,
             "A status report will be sent to your Sidekick chat room shortly.")
         do_status_ooo(get_cached_user_IM(uid), uid)
         return
@@ -550,10 +2358,10 @@ def do_ooo(e, line, args):
     # print line
     if line[0] == 'cancel':
         if len(line) == 1 or line[1] == '':
-            do_status_ooo(e['streamId'], uid)
-            SKS.data['user'][uid]['ooo'] = []
-            SKS.dirty = True
-            send_txt_message(e['streamId'], "All OOO entries above were deleted")
+            do_status_ooo(ctx.sid, uid)
+            oooEngine.remove_all(uid)
+            SKS.setVal(['user', uid, 'ooo'], [])
+            send_txt_message(ctx.sid, "All OOO entries above were deleted")
             return
         nr = 0
         try:
@@ -567,14 +2375,14 @@ def do_ooo(e, line, args):
             nr -= 1
             msg = "ooo entry for %s (%s) was removed" % (olist[nr]['till'],
                                                            olist[nr]['msg'])
-            del olist[nr]
-            SKS.dirty = True
-        send_txt_message(e['streamId'], msg)
+            oooEngine.remove(uid, olist[nr])
+            SKS.delVal(['user', uid, 'ooo', nr])
+        send_txt_message(ctx.sid, msg)
         return
 
     sid = get_cached_user_IM(uid)
-    if False and sid == e['streamId'] and not allRooms:
-        send_txt_message(e['streamId'], "This is a private room, only you " +
+    if False and sid == ctx.sid and not allRooms:
+        send_txt_message(ctx.sid, "This is a private room, only you " +
                          "would see the OOO messages.\nAdd -all after the " +
                          "ooo keyword to cover all rooms, or issue the " +
                          "ooo command in a room shared with others.")
@@ -583,62 +2391,31 @@ def do_ooo(e, line, args):
     try:
         dt = datetime.strptime(line[0], '%x')
     except:
-        send_txt_message(e['streamId'], "Cannot parse date %s" % line[0])
+        send_txt_message(ctx.sid, "Cannot parse date %s" % line[0])
         return
     if dt < datetime.today():
-        send_txt_message(e['streamId'],
+        send_txt_message(ctx.sid,
                      "ooo command: date '%s' already over" % dt.strftime('%x'))
         return
 
-    o = { 'till' : line[0], 'msg' : line[1], 'notified' : {} }
+    o = { 'till' : line[0], 'msg' : line[1] }
     if allRooms:
         sid = '*'
     else:
-        sid = e['streamId']
+        sid = ctx.sid
     o['stream'] = sid
-    SKS.data['user'][uid]['ooo'].append(o)
-    SKS.dirty = True
+    SKS.appendVal(['user', uid, 'ooo'], o)
+    oooEngine.add(uid, o)
 
     if sid == '*':
         sid = "in all rooms"
     else:
         sid = "in this room only"
-    send_with_mention(e['streamId'], uid,
+    send_with_mention(ctx.sid, uid,
                       "Your new OOO message is active until %s: %s (%s)" % \
                                                      (line[0], line[1], sid))
 
-def do_ooo_notification(sid, uid):
-    if not uid in SKS.data['user']:
-        return
-    olist = SKS.data['user'][uid]['ooo']
-    now = datetime.today()
-    nowstr = now.strftime('%x')
-    for o in olist:
-        # only notify if all rooms selected, or if in originating room
-        if not o['stream'] == sid and \
-           not o['stream'] == '*':
-            continue
-        dt = datetime.strptime(o['till'], '%x')
-        # remove stale entry:
-        if dt < now:
-            olist.remove(o)
-            SKS.dirty = True
-            continue
-        if sid in o['notified'] and o['notified'][sid] == nowstr:
-            continue
-        reply = "This is an out-of-office message on behalf of %s:\n" % \
-                get_cached_user_name(uid)
-        reply += "away until %s because of \"%s\"" % (o['till'], o['msg'])
-        send_txt_message(e['streamId'], reply)
-        # update all active ooo entries (with matching streamId)
-        for o in olist:
-            if o['stream'] == sid or o['stream'] == '*':
-                o['notified'][sid] = nowstr
-                SKS.dirty = True
-        
-        break
-
-def do_version(e, line, args):
+def do_version(ctx, line, args):
     with open(__cert__[0], "r") as f:
         bot = re.compile('/CN=([^ /]+)/').search(f.read()).group(1)
     s  = "This is Sidekick\n"
@@ -648,28 +2425,143 @@ def do_version(e, line, args):
     s += "- database has %d users and %d rooms\n" % \
                (len(SKS.data['user']), len(SKS.data['config']['myStreamIDs']))
     s += "v0.1, July 2016, cft@symphony.com"
-    send_txt_message(e['streamId'], s)
+    send_txt_message(ctx.sid, s)
+
+def is_admin(uid):
+    return uid in (SKS.config_get('admins') or [])
+
+class ProfileWindow:
+    '''
+    cProfile over the event loop for a bounded time, started by
+    '/sk profile'. cProfile only sees the thread enabling it, so both
+    start() (from the command, in handle_event) and check() run on the
+    main loop's thread; check() ends the window at the first batch or
+    keep-alive after it is over, and sends the top entries by
+    cumulative time to the admin's IM.
+    '''
+
+    MAX = 600                   # longest window, in seconds
+    TOP = 25                    # functions listed in the summary
+
+    def __init__(self):
+        self.prof = None
+        self.uid = None
+        self.since = None
+        self.until = None
+
+    def start(self, uid, secs):
+        if self.prof:
+            return False
+        self.uid = uid
+        self.since = _time.time()
+        self.until = self.since + secs
+        self.prof = cProfile.Profile()
+        self.prof.enable()
+        return True
+
+    def check(self):
+        if self.prof is None or _time.time() < self.until:
+            return
+        self.prof.disable()
+        prof, self.prof = self.prof, None
+        fn = os.environ['HOME'] + '/.symphony/sidekick-profile-' + \
+             datetime.today().strftime('%Y%m%d-%H%M%S') + '.prof'
+        prof.dump_stats(fn)
+        os.chmod(fn, 0o600)
+        buf = StringIO.StringIO()
+        pstats.Stats(prof, stream=buf).strip_dirs() \
+                           .sort_stats('cumulative').print_stats(self.TOP)
+        trace('profile of %.0fs written to %s' % (_time.time() - self.since,
+                                                 fn), cat='profile')
+        with SKS.lock:
+            send_txt_message(get_cached_user_IM(self.uid),
+                             "Profile of %.0fs, full profile in %s:\n%s" %
+                             (_time.time() - self.since, fn,
+                              buf.getvalue().strip()))
+
+profiler = ProfileWindow()
+
+def do_profile(ctx, line, args):
+    if not is_admin(ctx.uid):
+        send_txt_message(ctx.sid, "profile: for admins only")
+        return
+    secs = 60
+    if len(args) > 2:
+        secs = parse_interval(args[2])
+    if secs is None or secs < 1 or secs > ProfileWindow.MAX:
+        send_txt_message(ctx.sid, "profile: expecting a duration up to %s,"
+                         " like 60s or 5m" % render_interval(ProfileWindow.MAX))
+        return
+    if not profiler.start(ctx.uid, secs):
+        send_txt_message(ctx.sid, "profile: already running, until %s" %
+                         datetime.fromtimestamp(profiler.until).strftime(
+                                                                 '%H:%M:%S'))
+        return
+    send_txt_message(ctx.sid, "profiling for %s, results will go to your IM"
+                     % render_interval(secs))
+
+def do_log(ctx, line, args):
+    if not is_admin(ctx.uid):
+        send_txt_message(ctx.sid, "log: for admins only")
+        return
+    if len(args) == 4 and args[2] == 'level' and \
+       args[3] in TraceLog.LEVELS:
+        tracelog.set_level(args[3])
+    elif len(args) == 5 and args[2] == 'sample' and \
+         re.match('^(0(\.[0-9]*)?|1(\.0*)?)$', args[4]):
+        tracelog.sample[args[3]] = float(args[4])
+    elif len(args) > 2:
+        send_txt_message(ctx.sid, "log: expecting 'level debug|info|warn|"
+                         "error' or 'sample CATEGORY FRACTION'")
+        return
+    send_txt_message(ctx.sid, "log: level %s, sampled: %s\n- file %s" %
+                     (tracelog.level_name(), ', '.join(["%s %g" % (c, r)
+                      for c, r in sorted(tracelog.sample.items())]) or
+                      'none', tracelog.fn))
+
+def do_stats(ctx, line, args):
+    if not is_admin(ctx.uid):
+        send_txt_message(ctx.sid, "stats: for admins only")
+        return
+    send_txt_message(ctx.sid, "Sidekick stats:\n" + metrics.summary())
 
-def do_watch(e, line, args):
-    uid = str(e['fromUserId'])
+def do_watch(ctx, line, args):
+    uid = ctx.uid
     if len(args) < 3:
-        send_txt_message(e['streamId'],
+        send_txt_message(ctx.sid,
             "A status report will be sent to your Sidekick chat room shortly.")
         do_status_watch(get_cached_user_IM(uid), uid)
         return
     # print "watch command: %s" % str(args)
     allRooms = False
-    if len(args) > 2 and args[2] == '-all':
-        allRooms = True
-        del args[2]
-    line = line[line.index(args[2]):].split(' ', 1)
+    digest = 0
+    k = 2                       # the token after the options
+    while len(args) > k and args[k] in ['-all', '-digest', '-daily']:
+        if args[k] == '-all':
+            allRooms = True
+        elif args[k] == '-daily':
+            digest = 86400
+        elif len(args) < k + 2 or parse_interval(args[k + 1]) is None:
+            digest = 86400 # plain -digest: daily
+        else:
+            digest = parse_interval(args[k + 1])
+            k += 1
+        k += 1
+    if digest and digest < 60:
+        send_txt_message(ctx.sid, "watch: digest interval must be 1m or more")
+        return
+    if len(args) <= k:
+        send_txt_message(ctx.sid, "watch: missing REGEXP")
+        return
+    # by position (args is line.split(' ')): an option's text may recur
+    line = line[len(' '.join(args[:k])) + 1:].split(' ', 1)
     print line
     if line[0] == 'cancel':
         if len(line) == 1 or line[1] == '':
-            do_status_watch(e['streamId'], uid)
-            SKS.data['user'][uid]['watch'] = []
-            SKS.dirty = True
-            send_txt_message(e['streamId'], "All watch entries above were deleted")
+            do_status_watch(ctx.sid, uid)
+            SKS.setVal(['user', uid, 'watch'], [])
+            watchIndex.update_user(uid, [])
+            send_txt_message(ctx.sid, "All watch entries above were deleted")
             return
         nr = 0
         try:
@@ -681,34 +2573,45 @@ def do_watch(e, line, args):
             msg = "invalid number or number out of range"
         else:
             nr -= 1
-            msg = "watch entry for '%s' was removed" % olist[nr]['regex']
-            del wlist[nr]
-            SKS.dirty = True
-        send_txt_message(e['streamId'], msg)
+            msg = "watch entry for '%s' was removed" % wlist[nr]['regex']
+            SKS.delVal(['user', uid, 'watch', nr])
+            watchIndex.update_user(uid, wlist)
+        send_txt_message(ctx.sid, msg)
         return
 
     sid = get_cached_user_IM(uid)
-    if False and sid == e['streamId'] and not allRooms:
-        send_txt_message(e['streamId'], "This is a private room, only you " +
+    if False and sid == ctx.sid and not allRooms:
+        send_txt_message(ctx.sid, "This is a private room, only you " +
                          "would see matching messages.\nAdd -all after the " +
                          "watch keyword to cover all rooms, or issue the " +
                          "watch command in a room shared with others.")
         return
 
+    try:
+        re.compile(line[0])
+    except re.error, details:
+        send_txt_message(ctx.sid, "Cannot compile regex '%s' (%s)" % \
+                                                    (line[0], str(details)))
+        return
+
     w = { 'regex' : line[0] }
     if allRooms:
         sid = '*'
     else:
-        sid = e['streamId']
+        sid = ctx.sid
     w['stream'] = sid
-    SKS.data['user'][uid]['watch'].append(w)
-    SKS.dirty = True
+    if digest:
+        w['digest'] = digest
+    SKS.appendVal(['user', uid, 'watch'], w)
+    watchIndex.update_user(uid, SKS.data['user'][uid]['watch'])
 
     if sid == '*':
         sid = "in all rooms"
     else:
         sid = "in this room only"
-    send_with_mention(e['streamId'], uid,
+    if digest:
+        sid += ", as a digest every %s" % render_interval(digest)
+    send_with_mention(ctx.sid, uid,
                       "Your new watch task for '%s' is now active (%s)" % \
                                                               (line[0], sid))
 
@@ -717,17 +2620,26 @@ def do_watch(e, line, args):
 # layout of user data structure:
 '''
   uid : {
-    'alias'    : [ [s1,s2], ...]
+    'alias'    : { s1 : s2, ... }
     'announce' : [ ],
     'displayName': str,
     'email'    : str,
     'ooo'      : [ {
            'till'     : str,
            'msg'      : str,
+           'stream'   : str
+           } ],
+    'oooNotified' : { sid : str },
+    'watch'    : [ {
+           'regex'    : str,
            'stream'   : str,
-           'notified' : { sid : str }
+           'digest'   : int          # optional, seconds
            } ],
-    'watch'    : [ regexp1, ... ]
+    'digest'   : { str(seconds) : {
+           'due'      : float,
+           'items'    : [ [ time, room, user, line ] ],
+           'dropped'  : int
+           } }
   }
 '''
 
@@ -738,110 +2650,485 @@ command_table = {
     'examples': do_examples,
     'help'    : do_help,
     'intro'   : do_intro,
+    'log'     : do_log,
     'manage'  : not_implemented,
     'ooo'     : do_ooo,
+    'profile' : do_profile,
+    'stats'   : do_stats,
     'status'  : do_status,
     'version' : do_version,
     'watch'   : do_watch,
     }
 
-def hunt_for_announceTime():
-    now = datetime.today()
-    now = pytz.timezone(__SERVER_TIMEZONE__).localize(now)
-    for uid in SKS.data['user']:
-        alist = SKS.data['user'][uid]['announce']
-        for a in alist:
-            t = a['when'].split(' ')
-            dt = parse_time(t[0], t[1], t[2])
-            if now < dt:
+TRIGGERS = set(['/sk', '/sidekick'])
+aliasTriggers = collections.Counter() # alias trigger -> nr of users
+
+def upgrade_user(u):
+    # add missing sections, and convert old [s1,s2] alias lists
+    changed = False
+    for n in ['announce', 'ooo', 'watch']:
+        if not n in u:
+            u[n] = []
+            changed = True
+    if not 'alias' in u:
+        u['alias'] = {}
+        changed = True
+    elif isinstance(u['alias'], list):
+        u['alias'] = dict([ (a[0], a[1]) for a in u['alias'] ])
+        changed = True
+    for n in ['oooNotified', 'digest']:
+        if not n in u:
+            u[n] = {}
+            changed = True
+    for o in u['ooo']: # now kept per user, in 'oooNotified'
+        if 'notified' in o:
+            u['oooNotified'].update(o.pop('notified'))
+            changed = True
+    return changed
+
+def rebuild_alias_triggers(users):
+    aliasTriggers.clear()
+    for uid in users:
+        aliasTriggers.update(users[uid]['alias'].keys())
+
+def drop_alias_trigger(t):
+    aliasTriggers[t] -= 1
+    if aliasTriggers[t] <= 0:
+        del aliasTriggers[t]
+
+announceJobs = {}   # id(announce entry) -> scheduler job
+
+def schedule_announce(uid, a):
+    t = a['when'].split(' ')
+    dt = parse_time(t[0], t[1], t[2])
+    if dt == None:
+        trace('cannot schedule announcement by %s: %s' % (uid, str(a)),
+              'warn', 'announce')
+        return
+    announceJobs[id(a)] = scheduler.schedule(to_epoch(dt), fire_announce,
+                                             uid, a, dt)
+
+def unschedule_announce(a):
+    job = announceJobs.pop(id(a), None)
+    if job:
+        scheduler.cancel(job)
+
+def fire_announce(uid, a, dt):
+    del announceJobs[id(a)]
+    ct = ''
+    if 'createDate' in a:
+        ct = " from %s" % a['createDate']
+    reply = "This is a prerecorded message on behalf of %s%s: %s\n" % \
+                              (get_cached_user_name(uid), ct, a['msg'])
+    trace('announcement by %s re %s' % (uid, str(a)), cat='announce')
+    if a['stream'] == '*':
+        # streams of unknown type are asked about by the fan-out thread,
+        # not here with the store lock held
+        lst = []
+        unknown = set()
+        skipped = 0
+        types = SKS.data['config'].get('streamTypes', {})
+        for sid in SKS.data['config']['myStreamIDs']:
+            if sid in SKS.ims or rooms.dormant(sid):
+                skipped += 1
                 continue
-            ct = ''
-            if 'createDate' in a:
-                ct = " from %s" % a['createDate']
-            reply = "This is a prerecorded message on behalf of %s%s: %s\n" % \
-                                      (get_cached_user_name(uid), ct, a['msg'])
-            if a['stream'] == '*':
-                lst = SKS.data['config']['myStreamIDs']
-            else:
-                lst = [ a['stream'] ]
-            trace('announcement by %s re %s' % (uid, str(a)))
-            for sid in lst:
-                # XX if -all, we should loop over all non-IM rooms here,
-                # but the bridge API can't tell us which rooms are IMs...
-                send_txt_message(sid, reply)
-
-            if a['repeat'] == 'daily':
-                dt += timedelta(days=1)
-                a['when'] = render_time(dt)
-            elif a['repeat'] == 'weekly':
-                dt += timedelta(days=7)
-                a['when'] = render_time(dt)
-            elif a['repeat'] == 'monthly':
-                dt += timedelta(months=1)
-                a['when'] = render_time(dt)
-            else:
-                alist.remove(a)
-            SKS.dirty = True
+            if not sid in types:
+                unknown.add(sid)
+            lst.append(sid)
+        FanOut(outq, lst, reply,
+               check=lambda sid: not sid in unknown or not learn_IM(sid),
+               report=lambda results, left: report_announce(uid, a['msg'],
+                                      results, skipped + len(left))).start()
+    else:
+        send_txt_message(a['stream'], reply)
+
+    lst = SKS.data['user'][uid]['announce']
+    i = next(i for i, x in enumerate(lst) if x is a) # equal ones may exist
+    if not a['repeat'] in ['daily', 'weekly', 'monthly']:
+        SKS.delVal(['user', uid, 'announce', i])
+        return
+    # skip the repetitions we missed (e.g. while the bot was down)
+    now = _time.time()
+    while to_epoch(dt) <= now:
+        dt = next_repeat(dt, a['repeat'])
+    SKS.setVal(['user', uid, 'announce', i, 'when'], render_time(dt))
+    announceJobs[id(a)] = scheduler.schedule(to_epoch(dt), fire_announce,
+                                             uid, a, dt)
+
+def report_announce(uid, msg, results, skipped):
+    # tell the announcer in which rooms an -all announcement failed
+    failed = [sid for sid in results if results[sid] is not None]
+    trace('announcement by %s: %d rooms, %d failed, %d skipped' % \
+          (uid, len(results), len(failed), skipped), cat='announce')
+    with SKS.lock:
+        s = "Your announcement \"%s\" went to %d of %d rooms" % \
+                         (msg[:40], len(results) - len(failed), len(results))
+        if skipped > 0:
+            s += " (%d IMs and dormant rooms skipped)" % skipped
+        s += "\n"
+        for sid in failed:
+            s += "- failed in %s: %s\n" % (rooms.name(sid), str(results[sid]))
+        send_txt_message(get_cached_user_IM(uid), s)
+
+class OOOEngine:
+    '''
+    out-of-office entries, indexed by uid: a mention of a user without
+    active entries costs a dict lookup. Each entry's expiry is parsed
+    once and scheduled, so stale entries are removed by the scheduler
+    instead of being searched for. The user's 'oooNotified' maps a
+    streamId to the day we last told that room about the absence.
+    '''
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.active = collections.Counter() # uid -> nr of active entries
+        self.jobs = {}          # id(ooo entry) -> scheduler job
+
+    def rebuild(self, users):
+        for uid in users:
+            for o in list(users[uid]['ooo']):
+                self.add(uid, o)
+
+    def add(self, uid, o):
+        till = ooo_till(o)
+        if till is None:
+            trace('cannot schedule ooo expiry for %s: %s' % (uid, str(o)),
+                  'warn', 'ooo')
+            return
+        self.active[uid] += 1
+        self.jobs[id(o)] = self.scheduler.schedule(till, self._expire, uid, o)
+
+    def remove(self, uid, o):
+        job = self.jobs.pop(id(o), None)
+        if job is None:
+            return
+        self.scheduler.cancel(job)
+        self.active[uid] -= 1
+        if self.active[uid] <= 0:
+            del self.active[uid]
+            if SKS.data['user'][uid]['oooNotified']:
+                SKS.setVal(['user', uid, 'oooNotified'], {})
+
+    def remove_all(self, uid):
+        for o in SKS.data['user'][uid]['ooo']:
+            self.remove(uid, o)
+
+    def _expire(self, uid, o):
+        self.remove(uid, o)
+        olist = SKS.data['user'][uid]['ooo']
+        for i in range(len(olist)):
+            if olist[i] is o:
+                SKS.delVal(['user', uid, 'ooo', i])
+                break
+
+    def notify(self, sid, uids):
+        # one message for all out-of-office users mentioned in room sid
+        now = _time.time()
+        today = datetime.today().strftime('%x')
+        replies = []
+        for uid in collections.OrderedDict.fromkeys(uids):
+            if not uid in self.active:
+                continue
+            u = SKS.data['user'][uid]
+            if u['oooNotified'].get(sid) == today:
+                continue
+            # only if all rooms selected, or if in originating room
+            for i, o in SKS.ooo_entries(uid, sid):
+                job = self.jobs.get(id(o))
+                if job is None or job[0] <= now: # expiry not run yet
+                    continue
+                replies.append("This is an out-of-office message on behalf"
+                               " of %s:\naway until %s because of \"%s\"" %
+                               (get_cached_user_name(uid), o['till'],
+                                o['msg']))
+                SKS.setVal(['user', uid, 'oooNotified', sid], today)
+                break
+        if len(replies) > 0:
+            send_txt_message(sid, '\n\n'.join(replies))
+
+class WatchDigest:
+    '''
+    watch matches collected for a later, combined report. A user's
+    'digest' section holds one buffer per interval (seconds, as a
+    string key), started by the first match and flushed by the
+    scheduler when due. Buffers keep at most MAX_ITEMS matches and
+    count the ones dropped beyond that. A buffer is deleted once its
+    report is queued for sending.
+    '''
+
+    MAX_ITEMS = 50
+    MAX_LINE  = 300             # chars kept of each matching line
+    RETRY     = 300             # seconds, when the user's IM is not known
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.jobs = {}          # (uid, interval key) -> scheduler job
+
+    def rebuild(self, users):
+        for uid in users:
+            for key, buf in users[uid]['digest'].iteritems():
+                self.jobs[(uid, key)] = self.scheduler.schedule(
+                                           buf['due'], self.flush, uid, key)
+
+    def add(self, uid, digest, room, sender, line):
+        key = str(digest)
+        bufs = SKS.data['user'][uid]['digest']
+        if not key in bufs:
+            due = _time.time() + digest
+            SKS.setVal(['user', uid, 'digest', key],
+                       { 'due' : due, 'items' : [], 'dropped' : 0 })
+            self.jobs[(uid, key)] = self.scheduler.schedule(due, self.flush,
+                                                            uid, key)
+        buf = bufs[key]
+        if len(buf['items']) >= self.MAX_ITEMS:
+            SKS.setVal(['user', uid, 'digest', key, 'dropped'],
+                       buf['dropped'] + 1)
+            return
+        stamp = datetime.now(pytz.timezone(__SERVER_TIMEZONE__))
+        SKS.appendVal(['user', uid, 'digest', key, 'items'],
+                      [stamp.strftime('%x %H:%M'), room, sender,
+                       line[:self.MAX_LINE]])
+
+    def flush(self, uid, key):
+        self.jobs.pop((uid, key), None)
+        buf = SKS.data['user'][uid]['digest'].get(key)
+        if buf is None:
+            return
+        n = len(buf['items']) + buf['dropped']
+        s = "WATCH DIGEST (every %s): %d match%s\n" % \
+                    (render_interval(int(key)), n, '' if n == 1 else 'es')
+        for stamp, room, sender, line in buf['items']:
+            s += "%s  room %s, user %s\n  \"%s\"\n" % (stamp, room, sender,
+                                                        line)
+        if buf['dropped'] > 0:
+            s += "(%d more matches not shown)\n" % buf['dropped']
+        try:
+            im = get_cached_user_IM(uid)
+        except Exception, details: # keep the matches, try again later
+            trace("digest for %s: %s" % (uid, str(details)), 'warn', 'watch')
+            self.jobs[(uid, key)] = self.scheduler.schedule(
+                       _time.time() + self.RETRY, self.flush, uid, key)
+            return
+        send_txt_message(im, s)
+        SKS.delVal(['user', uid, 'digest', key])
+
+class memoized(object):
+    # a property computed on first use, then kept in the instance
+    def __init__(self, fn):
+        self.fn = fn
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        val = obj.__dict__[self.fn.__name__] = self.fn(obj)
+        return val
+
+class MessageML:
+    '''
+    the parts of a messageML message we look at, from one expat pass:
+    the text nodes directly below <messageML> ('texts'), whether the
+    message starts with one ('command'), and all <mention> uids. Input
+    that expat rejects goes through BeautifulSoup, which recovers.
+    '''
+
+    ASCII_SPACES = u'\x20\x0a\x09\x0c\x0d'
+
+    def __init__(self, xmlstr):
+        self.texts = []         # unicode, in document order
+        self.command = None     # the leading text node, if any
+        self.mentions = []      # uids, as strings
+        try:
+            self._parse(xmlstr)
+        except xml.parsers.expat.ExpatError:
+            self.texts, self.command, self.mentions = [], None, []
+            self._parse_soup(xmlstr)
+
+    def _parse(self, xmlstr):
+        depth = [0]
+        root = [None]
+        buf = []                # text run at depth 1, not yet ended
+        children = [0]
+
+        def end_text():
+            # a text run ends at the next child node (as in BeautifulSoup)
+            if len(buf) > 0:
+                t = u''.join(buf)
+                del buf[:]
+                if t.strip(self.ASCII_SPACES) == u'':
+                    t = u'\n' if u'\n' in t else u' '
+                if children[0] == 0:
+                    self.command = t
+                self.texts.append(t)
+                children[0] += 1
+
+        def start(name, attrs):
+            if depth[0] == 0:
+                root[0] = name
+            elif depth[0] == 1:
+                end_text()
+                children[0] += 1
+            if name == 'mention' and 'uid' in attrs:
+                self.mentions.append(attrs['uid'])
+            depth[0] += 1
+
+        def end(name):
+            depth[0] -= 1
+
+        def chars(data):
+            if depth[0] == 1:
+                buf.append(data)
+
+        def other(*args): # comments and PIs separate text runs
+            if depth[0] == 1:
+                end_text()
+                children[0] += 1
+
+        p = xml.parsers.expat.ParserCreate()
+        p.StartElementHandler = start
+        p.EndElementHandler = end
+        p.CharacterDataHandler = chars
+        p.CommentHandler = other
+        p.ProcessingInstructionHandler = other
+        if isinstance(xmlstr, unicode):
+            xmlstr = xmlstr.encode('utf-8')
+        p.Parse(xmlstr, True)
+        end_text()
+        if not root[0] == 'messageML':
+            self.texts, self.command = [], None
+
+    def _parse_soup(self, xmlstr):
+        msg = BeautifulSoup(xmlstr, 'xml')
+        self.mentions = [m.attrs['uid'] for m in msg.find_all('mention')
+                                                     if 'uid' in m.attrs]
+        if msg.messageML is None:
+            return
+        for i, c in enumerate(msg.messageML.contents):
+            if not type(c) == element.NavigableString:
+                continue
+            if i == 0:
+                self.command = unicode(c)
+            self.texts.append(unicode(c))
+
+class EventContext:
+    '''
+    one datafeed event, plus what the handlers derive from it. Each of
+    these is computed once, on first use, and shared by all stages;
+    run() keeps the time spent per stage in 'timings'.
+    '''
+
+    SLOW = 1.0                  # trace events taking longer (seconds)
+
+    def __init__(self, e):
+        self.e = e
+        self.sid = e['streamId']
+        self.uid = str(e['fromUserId']) if 'fromUserId' in e else None
+        self.timings = []       # [ (stage, seconds) ]
+
+    @memoized
+    def msg(self):
+        return MessageML(self.e['message'])
+
+    @memoized
+    def mentions(self):
+        return self.msg.mentions
+
+    @memoized
+    def command(self):
+        # the leading text node, as ascii; None if there is none
+        if self.msg.command is None:
+            return None
+        line = self.msg.command.encode('ascii', 'backslashreplace')
+        if len(line) > 0 and line[-1:] == '\xa0':
+            line = line[:-1]
+        line.replace('\xa0', ' ')
+        return line
+
+    @memoized
+    def text(self):
+        # all text directly in the message, as ascii
+        return ' '.join([t.encode('ascii', 'backslashreplace')
+                         for t in self.msg.texts])
+
+    @memoized
+    def watches(self):
+        # (uid, digest) of the watches matching the text
+        return watchIndex.match(self.sid, self.text)
+
+    @memoized
+    def is_im(self):
+        return is_IM(self.sid)
+
+    @memoized
+    def sender_name(self):
+        return get_cached_user_name(self.uid)
+
+    @memoized
+    def room_name(self):
+        return rooms.name(self.sid)
+
+    def run(self, stage, fn, *args):
+        t0 = _time.time()
+        try:
+            return fn(self, *args)
+        finally:
+            self.timings.append((stage, _time.time() - t0))
+
+    def elapsed(self):
+        return sum([t for (stage, t) in self.timings])
 
-def hunt_for_command(e, msg):
+def hunt_for_mentions(ctx):
+    oooEngine.notify(ctx.sid, ctx.mentions) # check for ooo reactions
+
+def hunt_for_command(ctx):
     # while debugging: react in our test room only, be deaf elsewhere
-    if '__TESTROOM__' in globals() and not e['streamId'] == __TESTROOM__:
+    if '__TESTROOM__' in globals() and not ctx.sid == __TESTROOM__:
         return
 
     # does message start with text?
-    if len(msg.messageML.contents) == 0 or \
-         not type(msg.messageML.contents[0]) == element.NavigableString:
+    line = ctx.command
+    if line is None:
+        return
+    # most messages start with no trigger of anybody: done
+    args = line.split(' ')
+    if not args[0] in TRIGGERS and not args[0] in aliasTriggers:
         return
-    line = msg.messageML.contents[0].encode('ascii',
-                                            'backslashreplace')
-    if len(line) > 0 and line[-1:] == '\xa0':
-        line = line[:-1]
-    line.replace('\xa0', ' ')
 
-    uid = str(e['fromUserId'])
+    uid = ctx.uid
     if not uid in SKS.data['user']: # add user to our database
-        SKS.data['user'][uid] = {
-            'alias' : [], 'announce' : [], 'ooo' : [], 'watch' : []
-        }
-        SKS.dirty = True
+        SKS.setVal(['user', uid], {
+            'alias' : {}, 'announce' : [], 'ooo' : [], 'oooNotified' : {},
+            'watch' : [], 'digest' : {}
+        })
 
-    args = line.split(' ')
-    if not args[0] in ['/sk', '/sidekick']:
+    if not args[0] in TRIGGERS:
         # see if sending user had a private trigger
-        a = [a for a in SKS.data['user'][uid]['alias'] if a[0] == args[0]]
-        if a == []:
+        a = SKS.data['user'][uid]['alias'].get(args[0])
+        if a is None:
             return
-        # print "doing alias rewriting: %s --> %s" % (args[0], a[0][1])
-        args[0] = a[0][1]
+        # print "doing alias rewriting: %s --> %s" % (args[0], a)
+        args[0] = a
         line = ' '.join(args)
         args = line.split(' ') # parse the (rewritten) command line again
 
     # print args
-    if not args[0] in ['/sk', '/sidekick']:
-        send_txt_message(e['streamId'], "Unknown Sidekick trigger %s" % line)
+    if not args[0] in TRIGGERS:
+        send_txt_message(ctx.sid, "Unknown Sidekick trigger %s" % line)
         return
 
     # trigger was recognized, now react:
-    trace('cmd by %s in %s' % (uid, str(e)))
+    trace('cmd by %s in %s' % (uid, str(ctx.e)), cat='cmd')
     if len(args) == 1:
-        command_table['intro'](e, line, args)
+        command_table['intro'](ctx, line, args)
     elif args[1] in command_table:
-        command_table[args[1]](e, line, args)
+        command_table[args[1]](ctx, line, args)
     else:
-        send_txt_message(e['streamId'], "Unknown command %s" % args[1])
+        send_txt_message(ctx.sid, "Unknown command %s" % args[1])
 
-def hunt_for_regex(e, msg):
-    # flatten the msg:
-    line = []
-    for c in msg.messageML.contents:
-        if not type(c) == element.NavigableString:
-            continue
-        line.append(c.encode('ascii', 'backslashreplace'))
-    line = ' '.join(line)
-
-    orig_uid = str(e['fromUserId'])
-    orig_sid = e['streamId']
-    if is_IM(orig_sid): # never watch a private IM
+def hunt_for_regex(ctx):
+    line = ctx.text
+    orig_uid = ctx.uid
+    orig_sid = ctx.sid
+    if ctx.is_im: # never watch a private IM
         return
 
     # do the bot war
@@ -850,23 +3137,376 @@ def hunt_for_regex(e, msg):
             continue
         regexp = re.compile(b['trigger'])
         if regexp.search(line):
-            b['action'](e['streamId'], orig_uid, line)
+            b['action'](orig_sid, orig_uid, line)
 
-    for uid in SKS.data['user']:
-        wlist = SKS.data['user'][uid]['watch']
-        for w in wlist:
-            if not w['stream'] == '*' and not w['stream'] == orig_sid:
-                continue;
-            regexp = re.compile(w['regex'])
-            if not regexp.search(line):
+    for uid, digest in ctx.watches:
+        trace('watch for "%s"' % uid, cat='watch')
+        if digest:
+            watchDigest.add(uid, digest, ctx.room_name, ctx.sender_name, line)
+            continue
+        sid = get_cached_user_IM(uid)
+        send_txt_message(sid,
+                         "WATCH REPORT: room %s, user %s\n\"%s\"" %
+                         (ctx.room_name, ctx.sender_name, line))
+
+def handle_keepalive():
+    try:
+        with SKS.lock:
+            rooms.flush()
+            SKS.sync()
+        scheduler.tick()
+    except Exception, details:
+        s = "Error in periodic: " + str(details)
+        trace(s, 'error')
+        print s
+
+def handle_event(e, found=None):
+    # found: what a shard worker has computed already (see ShardPool)
+    with SKS.lock:
+        # collect all streamIds for which we receive msgs
+        # (meaning: these are the streams we are part of,
+        #  the bridge/API cannot produce that list ...)
+        if not e['streamId'] in myStreamIDs:
+            SKS.appendVal(['config', 'myStreamIDs'], e['streamId'])
+        rooms.seen(e['streamId'])
+
+        if not 'message' in e:
+            return
+        ctx = EventContext(e)
+        if found:
+            ctx.__dict__.update(found)
+        try:
+            if ctx.uid == my_id: # skip own msgs
+                return
+            trace(e, cat='event') # sampled
+            ctx.run('ooo', hunt_for_mentions)
+            ctx.run('command', hunt_for_command)
+            ctx.run('watch', hunt_for_regex)
+        except Exception, details:
+            s = "Error in cmd: %s %s" % (str(e), str(details))
+            trace(s, 'error')
+            print s
+        for stage, t in ctx.timings:
+            metrics.observe('sidekick_handler_seconds', t, stage=stage)
+        if ctx.elapsed() > ctx.SLOW:
+            trace("slow event %s: %s" % (e.get('id'), ', '.join(
+                  ["%s %.3fs" % (stage, t) for (stage, t) in ctx.timings])),
+                  'warn', 'slow')
+
+# ---------------------------------------------------------------------------
+# sharded processing (--workers N)
+
+def shard_of(sid, n):
+    return (zlib.crc32(sid) & 0xffffffff) % n
+
+def match_event(e):
+    # the read-only, CPU-bound part of handling a message, as done by a
+    # shard: the EventContext fields handle_event() may take from it
+    ctx = EventContext(e)
+    return { 'text' : ctx.text, 'command' : ctx.command,
+             'mentions' : ctx.mentions, 'watches' : ctx.watches }
+
+def shard_worker(i, inq, outq):
+    # main of a forked shard process; its trace log is its own
+    global tracelog
+    tracelog = TraceLog('sidekick-shard%d' % i)
+    metrics.lock = threading.Lock() # may have been held when forking
+    while True:
+        cmd, arg = inq.get()
+        if cmd == 'stop':
+            return
+        if cmd == 'watch':
+            watchIndex.update_user(*arg)
+            continue
+        results = []
+        for e in arg:
+            try:
+                results.append(match_event(e))
+            except Exception, details:
+                trace("Error in shard for %s: %s" % (str(e), str(details)),
+                      'error')
+                results.append(None) # handled in full by the owner
+        outq.put(results)
+
+class ShardPool:
+    '''
+    the CPU-bound part of handling messages (parsing, watch matching)
+    done by N forked worker processes, partitioned by streamId. All the
+    rest, i.e. all state changes, commands and replies, stays with this
+    process as the single owner of the store: a handler thread takes
+    the shards' results and handles the events in their original
+    order, while the shards work on the next batches (up to DEPTH).
+    Watch changes are mirrored to the shards' copies of the WatchIndex;
+    messages already handed out are matched against the old watches.
+    '''
+
+    DEPTH = 4                   # batches handed out, not yet handled
+
+    def __init__(self, n):
+        # fork before any other thread is running, if possible
+        self.n = n
+        self.inqs = [ multiprocessing.Queue() for i in range(n) ]
+        self.outqs = [ multiprocessing.Queue() for i in range(n) ]
+        self.procs = []
+        for i in range(n):
+            p = multiprocessing.Process(target=shard_worker,
+                                        name='shard-%d' % i,
+                                        args=(i, self.inqs[i], self.outqs[i]))
+            p.daemon = True
+            p.start()
+            self.procs.append(p)
+        self.tickets = Queue.Queue(self.DEPTH)
+        self.error = None
+        watchIndex.mirrors.append(self)
+        self.thread = threading.Thread(target=self._run, name='shards')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def update_user(self, uid, wlist):
+        wlist = [ dict(w) for w in wlist ] # queued, pickled later
+        for q in self.inqs:
+            q.put(('watch', (uid, wlist)))
+
+    def submit(self, batch):
+        # hands out the messages of a batch; blocks while DEPTH in flight
+        if self.error:
+            raise self.error
+        shards = []
+        parts = [ [] for i in range(self.n) ]
+        for e in batch:
+            i = None
+            if e and 'message' in e and not str(e.get('fromUserId')) == my_id:
+                i = shard_of(e['streamId'], self.n)
+                parts[i].append(e)
+            shards.append(i)
+        for i in range(self.n):
+            if parts[i]:
+                self.inqs[i].put(('events', parts[i]))
+        self.tickets.put((batch, shards, [ len(p) > 0 for p in parts ],
+                          _time.time()))
+
+    def _results(self, i):
+        while True:
+            try:
+                return self.outqs[i].get(True, 1.0)
+            except Queue.Empty:
+                if not self.procs[i].is_alive():
+                    raise RuntimeError("shard %d has died" % i)
+
+    def _run(self):
+        while True:
+            batch, shards, used, t0 = self.tickets.get()
+            try:
+                results = [ iter(self._results(i)) if used[i] else None
+                            for i in range(self.n) ]
+                metrics.observe('sidekick_shard_seconds', _time.time() - t0)
+                for e, i in zip(batch, shards):
+                    if e is None:
+                        handle_keepalive()
+                    elif i is None:
+                        handle_event(e)
+                    else:
+                        handle_event(e, next(results[i]))
+                if self.tickets.empty() or SKS.commit_due():
+                    with SKS.lock:
+                        SKS.sync()
+                profiler.check() # (profiling this thread, see do_profile)
+            except Exception, details:
+                s = "Error in shard pool: " + str(details)
+                trace(s, 'error')
+                print s
+                if isinstance(details, RuntimeError):
+                    self.error = details
+            self.tickets.task_done()
+            if self.error:
+                return
+
+    def drain(self):
+        # waits until all submitted batches have been handled
+        with self.tickets.all_tasks_done:
+            while self.tickets.unfinished_tasks and not self.error:
+                self.tickets.all_tasks_done.wait(1.0)
+        if self.error:
+            raise self.error
+
+    def close(self):
+        self.drain()
+        watchIndex.mirrors.remove(self)
+        for q in self.inqs:
+            q.put(('stop', None))
+        for p in self.procs:
+            p.join()
+
+class DatafeedReader:
+    '''
+    reads the datafeed ahead, on its own thread: the next long-poll read
+    is issued while earlier events are still being processed. Events
+    are handed over in order through a bounded queue, which blocks the
+    reader when full; None stands for an empty keep-alive read. Reads
+    are also handed to the recorder, if any, as they came in.
+    '''
+
+    def __init__(self, bridge, feed_id, recorder=None, maxsize=500):
+        self.bridge = bridge
+        self.feed_id = feed_id
+        self.recorder = recorder
+        self.q = Queue.Queue(maxsize)
+        self.thread = None
+
+    def _run(self):
+        while True:
+            try:
+                t0 = _time.time()
+                events = self.bridge.read_datafeed(self.feed_id)
+                metrics.observe('sidekick_datafeed_read_seconds',
+                                _time.time() - t0)
+                if self.recorder:
+                    self.recorder.write(events)
+                if not events or len(events) == 0:
+                    metrics.observe('sidekick_datafeed_read_events', 0)
+                    self.q.put(None)
+                    continue
+                events = json.loads(events)
+                metrics.observe('sidekick_datafeed_read_events', len(events))
+                for e in events:
+                    self.q.put(e)
+            except Exception, details:
+                self.q.put(details) # re-raised by get()
+                return
+
+    def get(self):
+        while True: # (a timeout keeps the wait interruptible in python2)
+            try:
+                e = self.q.get(True, 1.0)
+                break
+            except Queue.Empty:
                 continue
-            sid = get_cached_user_IM(uid)
-            trace('watch for "%s"' % uid)
-            send_txt_message(sid,
-                             "WATCH REPORT: room %s, user %s\n\"%s\"" %
-                             (sym.get_room_name(orig_sid),
-                              get_cached_user_name(orig_uid), line))
-            break
+        if isinstance(e, Exception):
+            raise e
+        return e
+
+    def get_batch(self, maxn=100):
+        # the next event, plus the ones already queued behind it
+        batch = [self.get()]
+        while len(batch) < maxn:
+            try:
+                e = self.q.get_nowait()
+            except Queue.Empty:
+                break
+            if isinstance(e, Exception):
+                self.q.put(e) # the reader has stopped, raise it next time
+                break
+            batch.append(e)
+        return batch
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='datafeed')
+        self.thread.daemon = True
+        self.thread.start()
+
+class DatafeedRecorder:
+    '''
+    appends each raw datafeed read, with the time it came in, to a
+    gzipped JSONL file. Each recording session starts with a header
+    line (our uid). Flushed per read, so a crash loses little.
+    '''
+
+    def __init__(self, fn, my_id):
+        self.f = gzip.open(fn, 'ab')
+        self._write({ 't' : _time.time(), 'myId' : my_id,
+                      'version' : __SIDEKICK_VERSION__ })
+
+    def _write(self, rec):
+        self.f.write(json.dumps(rec) + '\n')
+        self.f.flush()
+
+    def write(self, raw):
+        self._write({ 't' : _time.time(), 'raw' : raw })
+
+class ReplayDone(Exception):
+    pass
+
+class ReplayBridge:
+    '''
+    stands in for SymphonyBridge when replaying a DatafeedRecorder file:
+    read_datafeed() returns the recorded reads, paced at 'speed' times
+    the recorded rate (0: as fast as possible), then raises ReplayDone.
+    The gap between recording sessions is skipped. Messages go to a
+    sink that only counts them; lookups get made-up answers, and
+    streams not yet in the store are taken for rooms.
+    '''
+
+    def __init__(self, fn, speed=1.0):
+        self.fn = fn
+        self.speed = speed
+        self.recs = self._records()
+        hdr = next(self.recs, None)
+        if hdr is None or not 'myId' in hdr:
+            raise ValueError("%s: not a datafeed recording" % fn)
+        self.myId = hdr['myId']
+        self.session = hdr['t'] # recorded start of the current session
+        self.start = None       # when we started replaying it
+        self.sent = 0
+        self.lock = threading.Lock()
+
+    def _records(self):
+        try:
+            with gzip.open(self.fn, 'rb') as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError: # torn write at the end
+                        return
+                    yield rec
+        except (IOError, EOFError), details: # recording was cut short
+            trace("replay of %s: %s" % (self.fn, str(details)),
+                  'warn', 'replay')
+
+    def read_datafeed(self, streamid):
+        if self.start is None:
+            self.start = _time.time()
+        for rec in self.recs:
+            if 'myId' in rec: # the bot was restarted while recording
+                self.session = rec['t']
+                self.start = _time.time()
+                continue
+            if self.speed > 0:
+                wait = self.start + (rec['t'] - self.session) / self.speed \
+                                                              - _time.time()
+                if wait > 0:
+                    _time.sleep(wait)
+            return rec['raw']
+        raise ReplayDone(self.fn)
+
+    def get_my_id(self):
+        return self.myId
+
+    def create_datafeed(self):
+        return 'replay'
+
+    def send_message(self, streamid, msgFormat, message, attachments=None):
+        with self.lock:
+            self.sent += 1
+        return '{}'
+
+    def get_user_info(self, uid):
+        return { 'displayName' : 'user %s' % uid,
+                 'emailAddress' : '%s@replay.invalid' % uid }
+
+    def get_users(self, uids):
+        return dict([ (uid, self.get_user_info(uid)) for uid in uids ])
+
+    def get_user_IM(self, uid):
+        return 'replay-im-' + uid
+
+    def get_stream_info(self, sid):
+        return { 'streamType' : { 'type' : 'ROOM' } }
+
+    def get_room_info(self, sid):
+        return { 'roomAttributes' : { 'name' : 'room %s' % sid } }
+
+    def get_room_members(self, sid):
+        return []
 
 # ---------------------------------------------------------------------------
 # bot war
@@ -883,12 +3523,9 @@ def reply_with_scotch(sid, uid, msg):
     raw = urllib2.urlopen(img).read()
 
     files = {'file': ('scotch.jpg', raw, 'image/jpeg')}
-    headers = {'sessionToken': sym.sessionToken,
-               'keyManagerToken': sym.keymngrToken}
-    r = requests.post(__url__ + \
-                          'agent/v1/stream/%s/attachment/create' % sid,
-                      cert=sym.certs, verify=True, files=files,
-                      headers=headers)
+    r = sym.agent.post(sym.url + \
+                           'agent/v1/stream/%s/attachment/create' % sid,
+                       files=files)
     imgId = r.json()['id']
 
     cheers = [ "Cheers!",
@@ -936,81 +3573,233 @@ bots = [
     ]
 
 # ---------------------------------------------------------------------------
+# startup: nothing above talks to the network until connect()
+
+def init_state(store):
+    '''
+    loads the store and rebuilds the in-memory indexes and scheduled
+    jobs from it; no network access
+    '''
+    global SKS, myStreamIDs, scheduler, oooEngine, watchDigest
+    SKS = store
+    SKS.load()
+    if not 'user' in SKS.data:
+        SKS.setVal(['user'], {})
+    if not 'config' in SKS.data:
+        SKS.setVal(['config'], { 'myStreamIDs' : [] })
+    if not 'sidekick.state.version' in SKS.data:
+        SKS.setVal(['sidekick.state.version'], '0.1')
+    if not 'rooms' in SKS.data:
+        SKS.setVal(['rooms'], {})
+    SKS.sync()  # creates the file if not yet existing
+    myStreamIDs = SKS.data['config']['myStreamIDs']
 
-now = datetime.today()
-now = pytz.timezone(__SERVER_TIMEZONE__).localize(now)
-startDate = render_time(now)
-print ">> " + startDate
-trace("start")
-
-SKS = SidekickStore()
-SKS.load()
-if not 'user' in SKS.data:
-    SKS.data['user'] = {}
-if not 'config' in SKS.data:
-    SKS.data['config'] = { 'myStreamIDs' : [] }
-if not 'sidekick.state.version' in SKS.data:
-    SKS.data['sidekick.state.version'] = '0.1'
-SKS.sync()  # creates the file if not yet existing
-myStreamIDs = SKS.data['config']['myStreamIDs']
-
-for uid in SKS.data['user']:
-    u = SKS.data['user'][uid]
-    for n in ['alias', 'announce', 'ooo', 'watch']:
-        if not n in u:
-            u[n] = []
-
-with open('sidekick-help.yaml', 'r') as f:
-    help_text = yaml.load(f.read())
+    for uid in SKS.data['user']:
+        if upgrade_user(SKS.data['user'][uid]):
+            SKS.dirty = True
+    watchIndex.rebuild(SKS.data['user'])
+    rebuild_alias_triggers(SKS.data['user'])
 
-# hit the net --------------------------------------------------------------v
-print ">> connecting ..."
-try:
-    sym = SymphonyBridge(__url__, __cert__)
+    scheduler = Scheduler(SKS.lock)
+    announceJobs.clear()
+    for uid in SKS.data['user']:
+        for a in SKS.data['user'][uid]['announce']:
+            schedule_announce(uid, a)
+    oooEngine = OOOEngine(scheduler)
+    oooEngine.rebuild(SKS.data['user'])
+    watchDigest = WatchDigest(scheduler)
+    watchDigest.rebuild(SKS.data['user'])
+
+def connect(bridge, **queue_opts):
+    '''
+    wires the bridge-dependent parts (user and room caches, outbound
+    queue) to an authenticated bridge; the queue is not started yet
+    '''
+    global sym, my_id, userdir, rooms, outq
+    sym = bridge
     my_id = sym.get_my_id()
-    datafeed_id = sym.create_datafeed()
-except Exception, details:
-    s = "Error contacting the corporate API bridge: " + str(details)
-    trace(s)
-    print s
-    sys.exit(-1)
-
-print ">> starting loop:"
-while True:
-    events = sym.read_datafeed(datafeed_id)
-
-    if not events or len(events) == 0: # empty keep-alive msg
+    userdir = UserDirectory(sym)
+    rooms = RoomRegistry(sym, SKS)
+    outq = OutboundQueue(sym, **queue_opts)
+
+def replay_home():
+    # a replay works on a copy of the store, in a temporary HOME
+    src = os.environ['HOME'] + '/.symphony/'
+    home = tempfile.mkdtemp(prefix='sidekick-replay-')
+    os.makedirs(home + '/.symphony', 0o700)
+    for fn in ['sidekick-store.json', 'sidekick-store.json.journal',
+               'sidekick-store.sqlite']:
+        if os.path.exists(src + fn):
+            shutil.copy2(src + fn, home + '/.symphony/' + fn)
+    os.environ['HOME'] = home
+    return home
+
+def replay_done(t0, nevents):
+    outq.drain()
+    with SKS.lock:
+        SKS.sync()
+    secs = _time.time() - t0
+    s = "replayed %d events in %.1fs (%.1f events/s), %d messages sent" % \
+                  (nevents, secs, nevents / max(secs, 1e-6), sym.sent)
+    trace(s, cat='replay')
+    print ">> " + s
+    print ">> store and trace left in " + os.environ['HOME']
+
+def main():
+    global __url__, __cert__, startDate, help_text
+
+    parser = argparse.ArgumentParser(description='The Sidekick Bot')
+    parser.add_argument('--store', choices=['json', 'sqlite'],
+                        default='json', help='storage backend')
+    parser.add_argument('--migrate-to-sqlite', action='store_true',
+                        help='copy the JSON store into a new SQLite store')
+    parser.add_argument('--url', default=__url__,
+                        help='API bridge to connect to (default: %(default)s)')
+    parser.add_argument('--cert', nargs=2, default=__cert__,
+                        metavar=('CERT', 'KEY'), help='client certificate')
+    parser.add_argument('--snapshots', action='store_true',
+                        help='list the snapshots of the JSON store')
+    parser.add_argument('--restore', type=int, metavar='N',
+                        help='restore the JSON store from snapshot N')
+    parser.add_argument('--record', metavar='FILE',
+                        help='append the datafeed reads to FILE (gzipped)')
+    parser.add_argument('--replay', metavar='FILE',
+                        help='process a recorded datafeed instead, on a copy'
+                             ' of the store, sending nothing')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='replay speed factor, 0 for as fast as possible'
+                             ' (default: %(default)s)')
+    parser.add_argument('--metrics-port', type=int, metavar='PORT',
+                        help='serve Prometheus metrics on localhost:PORT')
+    parser.add_argument('--admin', action='append', metavar='UID',
+                        help='allow UID to use the admin commands'
+                             ' (stats, profile, log)')
+    parser.add_argument('--workers', type=int, default=0, metavar='N',
+                        help='match messages in N worker processes')
+    parser.add_argument('--log-level', choices=sorted(TraceLog.LEVELS),
+                        default='info', help='trace log level')
+    parser.add_argument('--log-sample', action='append', metavar='CAT=RATE',
+                        help='log only this fraction of the records of'
+                             ' category CAT (default: event=0.01)')
+    opts = parser.parse_args()
+    tracelog.set_level(opts.log_level)
+    for s in opts.log_sample or []:
+        cat, rate = s.split('=', 1)
+        tracelog.sample[cat] = float(rate)
+    if opts.migrate_to_sqlite:
+        sys.exit(migrate_to_sqlite())
+    __url__ = opts.url
+    __cert__ = tuple(opts.cert)
+    if opts.snapshots:
+        for snap in SidekickStore().snapshots.list():
+            print "%4d  %s  %s" % (snap['n'], render_time(datetime.fromtimestamp(
+                snap['time'], pytz.timezone(__SERVER_TIMEZONE__))),
+                snap['file'])
+        sys.exit(0)
+    if opts.restore is not None:
+        if not SidekickStore().restore(opts.restore):
+            print ">> no snapshot %d" % opts.restore
+            sys.exit(1)
+        print ">> restored snapshot %d" % opts.restore
+        sys.exit(0)
+
+    if opts.replay:
+        print ">> replaying %s on a copy of the store in %s" % \
+                                                 (opts.replay, replay_home())
+
+    now = datetime.now(pytz.timezone(__SERVER_TIMEZONE__))
+    startDate = render_time(now)
+    print ">> " + startDate
+    trace("start")
+
+    if opts.store == 'sqlite':
+        init_state(SidekickSQLiteStore())
+    else:
+        init_state(SidekickStore())
+    for uid in opts.admin or []:
+        admins = SKS.config_get('admins') or []
+        if not uid in admins:
+            SKS.config_setVal('admins', admins + [uid])
+    pool = None
+    if opts.workers > 0:
+        pool = ShardPool(opts.workers)
+    if opts.metrics_port:
+        serve_metrics(opts.metrics_port)
+
+    with open('sidekick-help.yaml', 'r') as f:
+        help_text = yaml.load(f.read())
+
+    # hit the net ----------------------------------------------------------v
+    print ">> connecting ..."
+    try:
+        if opts.replay: # no rate limits towards the sink
+            connect(ReplayBridge(opts.replay, opts.speed),
+                    rate=1e9, stream_rate=1e9)
+        else:
+            connect(SymphonyBridge(__url__, __cert__, __pool__,
+                                   __keepalive__))
+        datafeed_id = sym.create_datafeed()
+    except Exception, details:
+        s = "Error contacting the corporate API bridge: " + str(details)
+        trace(s, 'error')
+        print s
+        sys.exit(-1)
+
+    outq.start()
+    atexit.register(outq.close)
+    scheduler.start()
+
+    recorder = None
+    if opts.record:
+        recorder = DatafeedRecorder(opts.record, my_id)
+    reader = DatafeedReader(sym, datafeed_id, recorder)
+    reader.start()
+
+    print ">> starting loop:"
+    t0 = _time.time()
+    nevents = 0
+    while True:
         try:
-            SKS.sync()
-            hunt_for_announceTime()
+            batch = reader.get_batch()
+        except ReplayDone:
+            if pool:
+                pool.drain()
+            replay_done(t0, nevents)
+            return
+        try:
+            userdir.prefetch(event_uids(batch))
         except Exception, details:
-            s = "Error in periodic: " + str(details)
-            trace(s)
+            s = "Error in user prefetch: " + str(details)
+            trace(s, 'error')
+            print s
+        if pool: # handled by the pool's thread
+            nevents += len([e for e in batch if e is not None])
+            pool.submit(batch)
+            continue
+        for i, e in enumerate(batch):
+            if e is None: # empty keep-alive msg
+                handle_keepalive()
+                continue
+            handle_event(e)
+            nevents += 1
+            # group commit: one journal write for a burst of events
+            if (i == len(batch) - 1 and reader.q.empty()) or \
+               SKS.commit_due():
+                try:
+                    with SKS.lock:
+                        SKS.sync()
+                except Exception, details:
+                    s = "Error in sync: " + str(details)
+                    trace(s, 'error')
+                    print s
+        try:
+            profiler.check()
+        except Exception, details:
+            s = "Error in profile: " + str(details)
+            trace(s, 'error')
             print s
-        continue
-
-    for e in json.loads(events):
-        # collect all streamIds for which we receive msgs
-        # (meaning: these are the streams we are part of,
-        #  the bridge/API cannot produce that list ...)
-        if not e['streamId'] in myStreamIDs:
-            myStreamIDs.append(e['streamId'])
-            SKS.dirty = True
 
-        if 'message' in e:
-            try:
-                if str(e['fromUserId']) == my_id: # skip own msgs
-                    continue
-                print
-                print e
-                msg = BeautifulSoup(e['message'], 'xml')
-                for m in msg.find_all("mention"): # check for ooo reactions
-                    do_ooo_notification(e['streamId'], m.attrs['uid'])
-                hunt_for_command(e, msg)
-                hunt_for_regex(e, msg)
-            except Exception, details:
-                s = "Error in cmd: %s %s" % (str(e), str(details))
-                trace(s)
-                print s
+if __name__ == '__main__':
+    main()
 
 # eof -----------------------------------------------------------------------